@@ -0,0 +1,222 @@
+import argparse
+import asyncio
+import contextlib
+import json
+import logging
+import math
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import statistics
+import string
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Dict, Callable, Tuple, Optional
+
+from tasks.FileMerger import FileMerger, create_merger, BACKEND_DISK, BACKEND_MEMORY, BACKEND_REDIS, DEFAULT_BLOCK_BYTES
+from tasks.FileMover import move_files, LockManager
+from tasks.LinesSorter import LinesSorter
+
+try:
+    import fakeredis
+except ImportError:
+    fakeredis = None
+
+# The task modules configure INFO logging on import; per-file messages would dominate the timings
+logging.getLogger().setLevel(logging.WARNING)
+logger = logging.getLogger(__name__)
+
+DEFAULT_SEED = 1234
+
+
+def generate_lines(path: str, lines: int, min_length: int = 1, max_length: int = 16, seed: int = DEFAULT_SEED) -> None:
+    rng = random.Random(seed)
+    with open(path, 'w') as file:
+        for _ in range(lines):
+            file.write(''.join(rng.choices(string.ascii_lowercase, k=rng.randint(min_length, max_length))) + '\n')
+
+
+def generate_name_files(directory: str, ids: int, seed: int = DEFAULT_SEED) -> Tuple[str, str]:
+    # Both files hold every ID once, each in its own random order
+    rng = random.Random(seed)
+    names_path = os.path.join(directory, 'names.txt')
+    surnames_path = os.path.join(directory, 'surnames.txt')
+    for path in (names_path, surnames_path):
+        order = list(range(1, ids + 1))
+        rng.shuffle(order)
+        with open(path, 'w') as file:
+            for id_ in order:
+                file.write(f"{''.join(rng.choices(string.ascii_letters, k=8))} {id_}\n")
+    return names_path, surnames_path
+
+
+def generate_file_tree(directory: str, files: int, size: int, seed: int = DEFAULT_SEED) -> List[str]:
+    rng = random.Random(seed)
+    paths = []
+    for i in range(files):
+        path = os.path.join(directory, f"file{i:07d}.bin")
+        with open(path, 'wb') as file:
+            file.write(rng.randbytes(size))
+        paths.append(path)
+    return paths
+
+
+def percentile(samples: List[float], fraction: float) -> float:
+    # Nearest-rank percentile
+    ordered = sorted(samples)
+    return ordered[max(0, min(len(ordered) - 1, math.ceil(fraction * len(ordered)) - 1))]
+
+
+def summarize(name: str, params: Dict, items: int, unit: str, elapsed: float) -> Dict:
+    return {
+        'name': name,
+        'params': params,
+        'throughput': items / max(elapsed, 1e-9),
+        'unit': unit,
+        'elapsed_seconds': elapsed,
+    }
+
+
+def summarize_latencies(name: str, params: Dict, items: int, unit: str, latencies: List[float],
+                        elapsed: float) -> Dict:
+    # Percentiles of per-item latencies, one sample per item
+    result = summarize(name, params, items, unit, elapsed)
+    result['p50_seconds'] = percentile(latencies, 0.50)
+    result['p99_seconds'] = percentile(latencies, 0.99)
+    return result
+
+
+def summarize_runs(name: str, params: Dict, items: int, unit: str, runs: List[float]) -> Dict:
+    # Only a handful of whole runs are timed, too few for percentiles to mean anything
+    result = summarize(name, params, items, unit, sum(runs))
+    result['min_run_seconds'] = min(runs)
+    result['median_run_seconds'] = statistics.median(runs)
+    result['max_run_seconds'] = max(runs)
+    return result
+
+
+def bench_sort_lines(lines: int, repeat: int, memory_limit=None, workers: int = 1) -> Dict:
+    with tempfile.TemporaryDirectory() as tempdir:
+        input_path = os.path.join(tempdir, 'lines.txt')
+        generate_lines(input_path, lines)
+        runs = []
+        for _ in range(repeat):
+            started = time.perf_counter()
+            sorted_lines = LinesSorter.sort_lines(input_path, memory_limit, workers)
+            if sorted_lines is None:
+                raise RuntimeError(f"sort_lines failed for {input_path}")
+            for _ in sorted_lines:
+                pass
+            runs.append(time.perf_counter() - started)
+    params = {'lines': lines, 'repeat': repeat, 'memory_limit': memory_limit, 'workers': workers}
+    return summarize_runs('lines_sorter.sort_lines', params, lines * repeat, 'lines/s', runs)
+
+
+def bench_file_merger(ids: int, repeat: int, chunk_size: int = 100, bulk: bool = False,
+                      block_bytes: Optional[int] = None, backend: str = BACKEND_REDIS) -> Dict:
+    # The local engines need no server; Redis is stood in for by fakeredis, so it omits network round trips
+    if backend == BACKEND_REDIS and fakeredis is None:
+        raise RuntimeError("fakeredis is required for the in-process Redis stand-in")
+    with tempfile.TemporaryDirectory() as tempdir:
+        names_path, surnames_path = generate_name_files(tempdir, ids)
+        runs = []
+        for i in range(repeat):
+            if backend == BACKEND_REDIS:
+                merger = FileMerger(redis_client=fakeredis.FakeRedis(), bulk=bulk, block_bytes=block_bytes)
+            else:
+                merger = create_merger(backend)
+            started = time.perf_counter()
+            asyncio.run(merger.main(names_path, surnames_path, os.path.join(tempdir, f'result{i}.txt'), chunk_size))
+            runs.append(time.perf_counter() - started)
+    params = {'ids': ids, 'repeat': repeat, 'chunk_size': chunk_size, 'bulk': bulk, 'block_bytes': block_bytes,
+              'backend': backend}
+    return summarize_runs('file_merger.main', params, 2 * ids * repeat, 'lines/s', runs)
+
+
+def bench_move_files(files: int, size: int, workers: int) -> Dict:
+    with tempfile.TemporaryDirectory() as tempdir:
+        source_dir = os.path.join(tempdir, 'source')
+        os.makedirs(source_dir)
+        sources = generate_file_tree(source_dir, files, size)
+        lock_manager = LockManager(os.path.join(tempdir, 'movers.lock'))
+        started = time.perf_counter()
+        results = move_files(sources, os.path.join(tempdir, 'dest'), workers, lock_manager)
+        elapsed = time.perf_counter() - started
+    failed = sum(1 for result in results if result.error is not None)
+    if failed:
+        logger.warning(f"{failed} moves failed")
+    params = {'files': files, 'size': size, 'workers': workers}
+    return summarize_latencies('file_mover.move_files', params, files - failed, 'files/s',
+                               [result.seconds for result in results], elapsed)
+
+
+def run_isolated(benchmark: Callable, kwargs: Dict) -> Dict:
+    # Each benchmark runs in its own process so its peak RSS is its own. Fork is preferred: a spawned
+    # child would also make the benchmarked process pools spawn, timing interpreter start-up instead.
+    method = 'fork' if 'fork' in multiprocessing.get_all_start_methods() else 'spawn'
+    with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context(method)) as executor:
+        return executor.submit(measure, benchmark, kwargs).result()
+
+
+def measure(benchmark: Callable, kwargs: Dict) -> Dict:
+    # move_file prints every destination path; keep stdout clean for the JSON report
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        result = benchmark(**kwargs)
+    # Largest of this process and its own worker processes; ru_maxrss is in KiB on Linux, bytes on macOS
+    peak_rss = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                   resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    result['peak_rss_bytes'] = peak_rss if sys.platform == 'darwin' else peak_rss * 1024
+    return result
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Benchmarks for the LinesSorter, FileMerger and FileMover hot paths')
+    parser.add_argument('--lines', type=int, default=200_000, help='lines sorted by the LinesSorter benchmark')
+    parser.add_argument('--ids', type=int, default=20_000, help='IDs in each FileMerger input file')
+    parser.add_argument('--files', type=int, default=2_000, help='files moved by the FileMover benchmark')
+    parser.add_argument('--file-size', type=int, default=4096)
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--only', choices=['sort', 'merge', 'move'], action='append',
+                        help='run only the given benchmarks; may be repeated')
+    parser.add_argument('--output', type=str, help='write the JSON report here instead of stdout')
+    args = parser.parse_args()
+
+    selected = args.only or ['sort', 'merge', 'move']
+    benchmarks = []
+    if 'sort' in selected:
+        benchmarks.append((bench_sort_lines, {'lines': args.lines, 'repeat': args.repeat}))
+        benchmarks.append((bench_sort_lines, {'lines': args.lines, 'repeat': args.repeat, 'workers': args.workers}))
+    if 'merge' in selected:
+        benchmarks.append((bench_file_merger, {'ids': args.ids, 'repeat': args.repeat}))
+        benchmarks.append((bench_file_merger, {'ids': args.ids, 'repeat': args.repeat, 'chunk_size': 1000,
+                                               'bulk': True}))
+        benchmarks.append((bench_file_merger, {'ids': args.ids, 'repeat': args.repeat, 'bulk': True,
+                                               'block_bytes': DEFAULT_BLOCK_BYTES}))
+        for backend in (BACKEND_MEMORY, BACKEND_DISK):
+            benchmarks.append((bench_file_merger, {'ids': args.ids, 'repeat': args.repeat, 'chunk_size': 1000,
+                                                   'backend': backend}))
+    if 'move' in selected:
+        benchmarks.append((bench_move_files, {'files': args.files, 'size': args.file_size, 'workers': args.workers}))
+
+    report = {
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'results': [run_isolated(benchmark, kwargs) for benchmark, kwargs in benchmarks],
+    }
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as file:
+            file.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
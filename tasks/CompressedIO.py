@@ -0,0 +1,142 @@
+import bz2
+import gzip
+import io
+import lzma
+import os
+import queue
+import re
+import threading
+from typing import Optional
+
+COMPRESSION_GZIP = 'gzip'
+COMPRESSION_BZ2 = 'bz2'
+COMPRESSION_XZ = 'xz'
+EXTENSIONS = {'.gz': COMPRESSION_GZIP, '.bz2': COMPRESSION_BZ2, '.xz': COMPRESSION_XZ}
+# bzip2 is matched on BZh, a block size digit and the first block's magic (or the end of stream magic of an
+# empty stream), since plain text may well start with BZh
+MAGIC_NUMBERS = ((re.compile(b'\x1f\x8b'), COMPRESSION_GZIP),
+                 (re.compile(b'BZh[1-9](?:1AY&SY|\x17rE8P\x90)'), COMPRESSION_BZ2),
+                 (re.compile(b'\xfd7zXZ\x00'), COMPRESSION_XZ))
+MAGIC_BYTES = 10
+OPENERS = {COMPRESSION_GZIP: gzip.open, COMPRESSION_BZ2: bz2.open, COMPRESSION_XZ: lzma.open}
+# gzip.open defaults to level 9, which costs several times the CPU of the gzip CLI's default 6 for little gain
+GZIP_LEVEL = 6
+READ_AHEAD_BYTES = 1024 * 1024
+READ_AHEAD_BLOCKS = 4
+SKIP_CHUNK_BYTES = 1024 * 1024
+POLL_SECONDS = 0.05
+
+
+class ThreadedReader(io.RawIOBase):
+    """Decompresses on a background thread into a bounded queue, so decompression overlaps the consumer's work."""
+
+    def __init__(self, source, block_bytes: int = READ_AHEAD_BYTES, depth: int = READ_AHEAD_BLOCKS):
+        self.source = source
+        self.block_bytes = block_bytes
+        self.blocks = queue.Queue(depth)
+        self.pending = memoryview(b'')
+        self.position = 0
+        self.eof = False
+        self.stop = threading.Event()
+        # zlib, bz2 and lzma release the GIL while decompressing, so this thread runs in parallel
+        self.thread = threading.Thread(target=self.fill, name='decompress', daemon=True)
+        self.thread.start()
+
+    def fill(self) -> None:
+        try:
+            while not self.stop.is_set():
+                data = self.source.read(self.block_bytes)
+                self.put(data)
+                if not data:
+                    return
+        except Exception as e:
+            self.put(e)
+
+    def put(self, item) -> None:
+        while not self.stop.is_set():
+            try:
+                self.blocks.put(item, timeout=POLL_SECONDS)
+                return
+            except queue.Full:
+                continue
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        while not self.pending:
+            if self.eof:
+                return 0
+            item = self.blocks.get()
+            if isinstance(item, Exception):
+                self.eof = True
+                raise item
+            if not item:
+                self.eof = True
+                return 0
+            self.pending = memoryview(item)
+        count = min(len(buffer), len(self.pending))
+        buffer[:count] = self.pending[:count]
+        self.pending = self.pending[count:]
+        self.position += count
+        return count
+
+    def tell(self) -> int:
+        return self.position
+
+    def close(self) -> None:
+        if not self.closed:
+            self.stop.set()
+            self.thread.join()
+            self.source.close()
+        super().close()
+
+
+def detect_compression(path: str) -> Optional[str]:
+    # The extension wins; otherwise the magic number of an existing file decides
+    compression = EXTENSIONS.get(os.path.splitext(path)[1].lower())
+    if compression is not None:
+        return compression
+    try:
+        with open(path, 'rb') as file:
+            head = file.read(MAGIC_BYTES)
+    except OSError:
+        return None
+    for magic, compression in MAGIC_NUMBERS:
+        if magic.match(head):
+            return compression
+    return None
+
+
+def open_file(path: str, mode: str = 'r', encoding: Optional[str] = None, newline: Optional[str] = None,
+              buffering: int = -1):
+    # Drop-in for open() on compressed and plain files alike; compressed reads are decompressed ahead on a thread.
+    # Writes are compressed when the path has a compression extension.
+    binary = 'b' in mode
+    if 'r' in mode:
+        compression = detect_compression(path)
+        if compression is None:
+            return open(path, mode, buffering, encoding=encoding, newline=newline)
+        stream = io.BufferedReader(ThreadedReader(OPENERS[compression](path, 'rb')), READ_AHEAD_BYTES)
+        return stream if binary else io.TextIOWrapper(stream, encoding=encoding, newline=newline)
+
+    compression = EXTENSIONS.get(os.path.splitext(path)[1].lower())
+    if compression is None:
+        return open(path, mode, buffering, encoding=encoding, newline=newline)
+    kwargs = {'compresslevel': GZIP_LEVEL} if compression == COMPRESSION_GZIP else {}
+    mode = mode if binary else mode.replace('t', '') + 't'
+    if binary:
+        return OPENERS[compression](path, mode, **kwargs)
+    return OPENERS[compression](path, mode, encoding=encoding, newline=newline, **kwargs)
+
+
+def skip(file, count: int) -> None:
+    # Forward seek that also works on decompressing streams, which cannot seek
+    if file.seekable():
+        file.seek(count, io.SEEK_CUR)
+        return
+    while count > 0:
+        data = file.read(min(count, SKIP_CHUNK_BYTES))
+        if not data:
+            break
+        count -= len(data)
@@ -1,31 +1,318 @@
+import argparse
 import asyncio
+import bisect
 import csv
+import hashlib
+import heapq
+import io
+import locale
 import logging
+import math
+import mmap
+import os
+import re
+import sys
+import tempfile
+import threading
+import time
+import zlib
 from concurrent.futures import ThreadPoolExecutor
-from typing import List, Tuple, Dict
+from itertools import chain, count, islice
+from typing import List, Tuple, Dict, Iterator, Optional, Set, Union
 
 import aiofiles
 import redis
+import redis.asyncio
+
+from tasks.CompressedIO import detect_compression, open_file, skip
+from tasks.Metrics import SampledLogger, counter, export, histogram
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
+sampled_logger = SampledLogger(logger)
+
+READ_SECONDS = histogram('file_merger_read_seconds', 'Time to read one chunk of input lines')
+VALIDATE_SECONDS = histogram('file_merger_validate_seconds', 'Time to parse and validate one chunk')
+PIPELINE_SECONDS = histogram('file_merger_pipeline_seconds', 'Time to validate and write one chunk to the store')
+LINES_TOTAL = counter('file_merger_lines_total', 'Input lines read')
+INVALID_LINES_TOTAL = counter('file_merger_invalid_lines_total', 'Input lines skipped as malformed')
+FAILED_CHUNKS_TOTAL = counter('file_merger_failed_chunks_total', 'Chunks that could not be written')
+
+DEFAULT_PIPELINE_BYTES = 1024 * 1024
+# Rough per-command RESP framing overhead used when sizing bulk pipelines
+COMMAND_OVERHEAD_BYTES = 32
+CHECKPOINTS_KEY = 'checkpoints'
+DEFAULT_MAX_CONNECTIONS = 16
+DEFAULT_MAX_IN_FLIGHT = 8
+DEFAULT_RUN_BYTES = 64 * 1024 * 1024
+EXPORT_BUFFER_BYTES = 1024 * 1024
+DEFAULT_BLOCK_BYTES = 1024 * 1024
+READER_LINES = 'lines'
+READER_BLOCKS = 'blocks'
+# A line holding exactly two fields; never spans lines, so one match per valid line
+RECORD_PATTERN = re.compile(rb'^[ \t]*(\S+)[ \t]+(\S+)[ \t]*\r?$', re.MULTILINE)
+# The same over decoded text, where whitespace is whatever str.split() splits on
+TEXT_RECORD_PATTERN = re.compile(r'^[^\S\r\n]*(\S+)[^\S\r\n]+(\S+)[^\S\r\n]*\r?$', re.MULTILINE)
+# ASCII bytes that str.split() treats as whitespace but a bytes pattern does not
+SEPARATOR_BYTES = re.compile(rb'[\x1c-\x1f]')
+FIELDS = ('First', 'Last')
+
+BACKEND_REDIS = 'redis'
+BACKEND_MEMORY = 'memory'
+BACKEND_DISK = 'disk'
+BACKENDS = (BACKEND_REDIS, BACKEND_MEMORY, BACKEND_DISK)
+
+LAYOUT_STANDARD = 'standard'
+LAYOUT_COMPACT = 'compact'
+LAYOUTS = (LAYOUT_STANDARD, LAYOUT_COMPACT)
+# Stays below the default hash-max-listpack-entries (128) so every bucket hash keeps the compact encoding
+COMPACT_BUCKET_SIZE = 100
+COMPACT_SEPARATOR = '\t'
+DEFAULT_VIRTUAL_NODES = 160
+DELTA_KEY_PREFIX = 'delta'
+# Average lines per content-defined chunk in incremental mode, and the hard cap on a chunk.
+# Small, so that a 1% change rate still leaves most chunks untouched.
+DELTA_CHUNK_LINES = 16
+DELTA_MAX_CHUNK_LINES = 8 * DELTA_CHUNK_LINES
+DELTA_BATCH = 1000
+
+# Merges one field into the packed "First<TAB>Last" value of each ID.
+# KEYS are the bucket hashes, ARGV is the field index followed by id/value pairs.
+PACK_SCRIPT = """
+local index = tonumber(ARGV[1])
+for i = 1, #KEYS do
+    local id = ARGV[2 * i]
+    local first, last = '', ''
+    local current = redis.call('HGET', KEYS[i], id)
+    if current then
+        local separator = string.find(current, '\t', 1, true)
+        first = string.sub(current, 1, separator - 1)
+        last = string.sub(current, separator + 1)
+    end
+    if index == 0 then
+        first = ARGV[2 * i + 1]
+    else
+        last = ARGV[2 * i + 1]
+    end
+    redis.call('HSET', KEYS[i], id, first .. '\t' .. last)
+end
+return #KEYS
+"""
+
+# Removes one field of each ID and drops IDs left without any field from sorted_ids.
+# KEYS are the IDs, ARGV[1] is the field.
+DELETE_SCRIPT = """
+local removed = 0
+for i = 1, #KEYS do
+    redis.call('HDEL', KEYS[i], ARGV[1])
+    if redis.call('EXISTS', KEYS[i]) == 0 then
+        removed = removed + redis.call('ZREM', 'sorted_ids', KEYS[i])
+    end
+end
+return removed
+"""
+
+
+class IngestError(Exception):
+    """An input file was not fully ingested, so no result may be exported from it."""
 
 
 class FileMerger:
-    def __init__(self, redis_host="127.0.0.1", redis_port=6379, redis_db=0, max_workers=20):
-        self.redis = redis.Redis(host=redis_host, port=redis_port, db=redis_db)
-        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+    def __init__(self, redis_host="127.0.0.1", redis_port=6379, redis_db=0, bulk=False,
+                 pipeline_bytes=DEFAULT_PIPELINE_BYTES, redis_client=None, block_bytes=None):
+        self.redis = redis_client if redis_client is not None else redis.Redis(host=redis_host, port=redis_port,
+                                                                               db=redis_db)
+        self.bulk = bulk
+        self.pipeline_bytes = pipeline_bytes
+        self.block_bytes = block_bytes
+        self.delete_script = self.redis.register_script(DELETE_SCRIPT)
 
-    async def process(self, path: str, key: str, chunk_size: int = 100) -> None:
+    async def process(self, path: str, key: str, chunk_size: int = 100, resume: bool = False) -> int:
+        # Every chunk is committed together with the byte offset it ends at, so resume=True
+        # continues right after the last chunk that reached Redis.
+        if self.block_bytes:
+            return await self.process_blocks(path, key, resume)
+        processed = 0
+        started = time.perf_counter()
+        process_data = self.process_data_bulk if self.bulk else self.process_data
+        checkpoint_field = self.checkpoint_field(path, key)
+        offset = 0
+        failed = False
         try:
-            async with aiofiles.open(path, 'r') as file:
+            async with self.open_lines(path) as file:
+                if resume:
+                    offset = self.load_checkpoint(checkpoint_field)
+                    await file.seek(offset)
+                if offset:
+                    logger.info(f"Resuming {path} from byte offset {offset}")
                 while True:
-                    lines = await self.read_chunk(file, chunk_size)
+                    with READ_SECONDS.time():
+                        lines = await self.read_chunk(file, chunk_size)
                     if not lines:
                         break
-                    await asyncio.to_thread(self.process_data, lines, key)
+                    LINES_TOTAL.inc(len(lines))
+                    chunk_end = await file.tell()
+                    with PIPELINE_SECONDS.time():
+                        committed = await asyncio.to_thread(process_data, lines, key, (checkpoint_field, chunk_end))
+                    if not committed:
+                        FAILED_CHUNKS_TOTAL.inc()
+                        logger.error(f"Stopped processing {path}; resume from byte offset {offset}")
+                        failed = True
+                        break
+                    offset = chunk_end
+                    processed += len(lines)
         except Exception as e:
-            logger.error(f"An error occurred while processing the file {path}: {e}")
+            logger.error(f"An error occurred while processing the file {path}, resume from byte offset {offset}: {e}")
+            failed = True
+        self.log_throughput(path, processed, time.perf_counter() - started)
+        if failed:
+            raise IngestError(f"{path} was not fully ingested; resume from byte offset {offset}")
+        return processed
+
+    async def process_blocks(self, path: str, key: str, resume: bool = False) -> int:
+        # Same contract as process(), but the file is mmapped and parsed block_bytes at a time into bytes
+        # records, and each block is parsed while the previous one is being written.
+        processed = 0
+        started = time.perf_counter()
+        process_records = self.process_records_bulk if self.bulk else self.process_records
+        checkpoint_field = self.checkpoint_field(path, key)
+        offset = self.load_checkpoint(checkpoint_field) if resume else 0
+        if offset:
+            logger.info(f"Resuming {path} from byte offset {offset}")
+        loop = asyncio.get_running_loop()
+        failed = False
+        try:
+            # Reading, decompressing and parsing a block run on the executor too, so they never stall the event
+            # loop and the other file's task
+            blocks = self.iter_blocks(path, self.block_bytes, offset)
+            block = await loop.run_in_executor(None, next, blocks, None)
+            while block is not None:
+                records, lines, block_end = block
+                LINES_TOTAL.inc(lines)
+                write_started = time.perf_counter()
+                write = loop.run_in_executor(None, process_records, records, key, (checkpoint_field, block_end))
+                block = await loop.run_in_executor(None, next, blocks, None)
+                committed = await write
+                PIPELINE_SECONDS.observe(time.perf_counter() - write_started)
+                if not committed:
+                    FAILED_CHUNKS_TOTAL.inc()
+                    logger.error(f"Stopped processing {path}; resume from byte offset {offset}")
+                    failed = True
+                    break
+                offset = block_end
+                processed += lines
+        except Exception as e:
+            logger.error(f"An error occurred while processing the file {path}, resume from byte offset {offset}: {e}")
+            failed = True
+        self.log_throughput(path, processed, time.perf_counter() - started)
+        if failed:
+            raise IngestError(f"{path} was not fully ingested; resume from byte offset {offset}")
+        return processed
+
+    @staticmethod
+    def open_lines(path: str):
+        # Plain files go through aiofiles; compressed ones through a reader that decompresses on a background thread
+        return aiofiles.open(path, 'r') if detect_compression(path) is None else CompressedLineReader(path)
+
+    @staticmethod
+    def iter_blocks(path: str, block_bytes: int = DEFAULT_BLOCK_BYTES,
+                    offset: int = 0) -> Iterator[Tuple[List[Tuple[bytes, bytes]], int, int]]:
+        # (records, lines, end offset) per block; blocks end right after a newline, so no line is split.
+        # Offsets of compressed files count decompressed bytes.
+        if detect_compression(path) is not None:
+            yield from FileMerger.iter_stream_blocks(path, block_bytes, offset)
+            return
+        with open(path, 'rb') as file:
+            size = os.fstat(file.fileno()).st_size
+            if offset >= size:
+                return
+            with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                start = offset
+                while start < size:
+                    with READ_SECONDS.time():
+                        end = min(start + block_bytes, size)
+                        if end < size:
+                            newline = data.rfind(b'\n', start, end)
+                            end = newline + 1 if newline >= 0 else data.find(b'\n', end) + 1 or size
+                        block = data[start:end]
+                    records, lines = FileMerger.parse_block(block)
+                    yield records, lines, end
+                    start = end
+
+    @staticmethod
+    def iter_stream_blocks(path: str, block_bytes: int,
+                           offset: int = 0) -> Iterator[Tuple[List[Tuple[bytes, bytes]], int, int]]:
+        with open_file(path, 'rb') as file:
+            skip(file, offset)
+            end = offset
+            remainder = b''
+            while True:
+                with READ_SECONDS.time():
+                    data = file.read(block_bytes)
+                    block = remainder + data
+                    cut = len(block) if not data else block.rfind(b'\n') + 1
+                    block, remainder = block[:cut], block[cut:]
+                if not block:
+                    if not data:
+                        return
+                    continue
+                end += len(block)
+                records, lines = FileMerger.parse_block(block)
+                yield records, lines, end
+
+    @staticmethod
+    def parse_block(block: bytes) -> Tuple[List[Tuple[Union[str, bytes], Union[str, bytes]]], int]:
+        # One regex pass over the block: over the bytes while they are plain ASCII, otherwise over the decoded
+        # text, whose whitespace (e.g. a no-break space) the bytes pattern would not split on. Only when some line
+        # does not hold exactly two fields is it split line by line, exactly as the line reader does.
+        lines = block.count(b'\n') + (not block.endswith(b'\n'))
+        plain = block.isascii() and not SEPARATOR_BYTES.search(block)
+        encoding = locale.getpreferredencoding(False)
+        with VALIDATE_SECONDS.time():
+            if plain:
+                matches = RECORD_PATTERN.findall(block)
+            else:
+                matches = TEXT_RECORD_PATTERN.findall(block.decode(encoding))
+            if len(matches) == lines:
+                return [(id_, value) for value, id_ in matches], lines
+        lines = block.splitlines()
+        if not plain:
+            lines = [line.decode(encoding) for line in lines]
+        return FileMerger.validate_lines(lines), len(lines)
+
+    @staticmethod
+    def benchmark_readers(path: str, chunk_size: int = 100, block_bytes: int = DEFAULT_BLOCK_BYTES) -> Dict[str, float]:
+        # Lines per second of reading and validating the whole file with each reader, without writing anything
+        async def read_lines() -> int:
+            lines = 0
+            async with FileMerger.open_lines(path) as file:
+                while True:
+                    chunk = await FileMerger.read_chunk(file, chunk_size)
+                    if not chunk:
+                        return lines
+                    FileMerger.validate_lines(chunk)
+                    lines += len(chunk)
+
+        rates = {}
+        started = time.perf_counter()
+        lines = asyncio.run(read_lines())
+        rates[READER_LINES] = lines / max(time.perf_counter() - started, 1e-9)
+        started = time.perf_counter()
+        lines = sum(block_lines for _, block_lines, _ in FileMerger.iter_blocks(path, block_bytes))
+        rates[READER_BLOCKS] = lines / max(time.perf_counter() - started, 1e-9)
+        return rates
+
+    @staticmethod
+    def checkpoint_field(path: str, key: str) -> str:
+        return f"{key}:{os.path.abspath(path)}"
+
+    def load_checkpoint(self, checkpoint_field: str) -> int:
+        offset = self.redis.hget(CHECKPOINTS_KEY, checkpoint_field)
+        return int(offset) if offset else 0
+
+    @staticmethod
+    def log_throughput(path: str, lines: int, elapsed: float) -> None:
+        logger.info(f"Processed {lines} lines from {path} in {elapsed:.2f}s ({lines / max(elapsed, 1e-9):.0f} lines/s)")
 
     @staticmethod
     async def read_chunk(file, chunk_size: int) -> List[str]:
@@ -36,43 +323,129 @@ class FileMerger:
                 break
         return lines
 
-    def process_data(self, lines: List[str], key: str) -> None:
+    def process_data(self, lines: List[str], key: str, checkpoint: Optional[Tuple[str, int]] = None) -> bool:
+        return self.process_records(self.validate_lines(lines), key, checkpoint)
+
+    def process_records(self, records: List[Tuple[str, str]], key: str,
+                        checkpoint: Optional[Tuple[str, int]] = None) -> bool:
+        # Records are (id, value) pairs, as str from validate_lines or as bytes from the block reader
         try:
             pipeline = self.redis.pipeline()
-            valid_lines = self.validate_lines(lines)
-            for id_, value in valid_lines:
+            for id_, value in self.numeric_records(records):
                 pipeline.hset(id_, mapping={key: value})
                 pipeline.zadd('sorted_ids', {id_: id_})
+            if checkpoint:
+                pipeline.hset(CHECKPOINTS_KEY, *checkpoint)
             pipeline.execute()
+            return True
+        except Exception as e:
+            logger.error(f"An error occurred while processing data: {e}")
+            return False
+
+    def process_data_bulk(self, lines: List[str], key: str, checkpoint: Optional[Tuple[str, int]] = None) -> bool:
+        return self.process_records_bulk(self.validate_lines(lines), key, checkpoint)
+
+    def process_records_bulk(self, records: List[Tuple[str, str]], key: str,
+                             checkpoint: Optional[Tuple[str, int]] = None) -> bool:
+        # Non-transactional pipelines flushed by byte budget, with one multi-member ZADD per flush
+        try:
+            pipeline = self.redis.pipeline(transaction=False)
+            for batch in self.batch_by_bytes(self.numeric_records(records), key):
+                for id_, value in batch:
+                    pipeline.hset(id_, key, value)
+                self.flush_pipeline(pipeline, {id_: id_ for id_, _ in batch})
+            if checkpoint:
+                # Only recorded once every batch of the chunk has been acknowledged
+                pipeline.hset(CHECKPOINTS_KEY, *checkpoint)
+                pipeline.execute()
+            return True
         except Exception as e:
             logger.error(f"An error occurred while processing data: {e}")
+            return False
+
+    def batch_by_bytes(self, valid_lines: List[Tuple[str, str]], key: str) -> Iterator[List[Tuple[str, str]]]:
+        batch = []
+        batch_bytes = 0
+        for id_, value in valid_lines:
+            batch.append((id_, value))
+            batch_bytes += 2 * len(id_) + len(key) + len(value) + COMMAND_OVERHEAD_BYTES
+            if batch_bytes >= self.pipeline_bytes:
+                yield batch
+                batch = []
+                batch_bytes = 0
+        if batch:
+            yield batch
+
+    @staticmethod
+    def flush_pipeline(pipeline, scores: Dict[str, str]) -> None:
+        if scores:
+            pipeline.zadd('sorted_ids', scores)
+        pipeline.execute()
 
     @staticmethod
     def validate_lines(lines: List[str]) -> List[Tuple[str, str]]:
-        valid_lines = []
-        for line in lines:
-            parts = line.split()
-            if len(parts) != 2:
-                logger.warning(f"Invalid line, skipped: {line}")
-                continue
-            valid_lines.append((parts[1], parts[0]))
-        return valid_lines
+        with VALIDATE_SECONDS.time():
+            valid_lines = []
+            for line in lines:
+                parts = line.split()
+                if len(parts) != 2:
+                    INVALID_LINES_TOTAL.inc()
+                    sampled_logger.warning('invalid_line', f"Invalid line, skipped: {line}")
+                    continue
+                valid_lines.append((parts[1], parts[0]))
+            return valid_lines
+
+    @staticmethod
+    def numeric_records(records: List[Tuple[str, str]]) -> List[Tuple[str, str]]:
+        # A non-numeric ID would fail its ZADD and with it the whole pipeline, so it is dropped here
+        return [(id_, value) for id_, value in records if id_score(id_) is not None]
 
     def print_result_file(self, result_file: str, chunk_size: int = 200):
-        start = 0
         try:
-            with open(result_file, 'a') as file:
+            with open_file(result_file, 'w', buffering=EXPORT_BUFFER_BYTES) as file:
                 writer = csv.writer(file, delimiter=' ')
-                while True:
-                    ids = self.get_ids(start, chunk_size)
-                    if not ids:
-                        break
-                    data = self.get_data_by_ids(ids)
-                    self.write_to_csv(writer, data)
-                    start += chunk_size
+                for rows in self.iter_rows(chunk_size):
+                    writer.writerows(rows)
         except Exception as e:
             logger.error(f"An error occurred while exporting file {result_file}: {e}")
 
+    def iter_rows(self, chunk_size: int = 200) -> Iterator[List[List[str]]]:
+        # Pages of [First, Last, ID] rows; the next page is fetched while the caller writes the current one
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            rows, cursor = self.fetch_rows(float('-inf'), 0, chunk_size)
+            while rows:
+                next_page = executor.submit(self.fetch_rows, *cursor, chunk_size)
+                yield rows
+                rows, cursor = next_page.result()
+
+    def fetch_rows(self, min_score: float, offset: int,
+                   chunk_size: int = 200) -> Tuple[List[List[str]], Optional[Tuple[float, int]]]:
+        # Seeks by score instead of rank; offset skips members tied with min_score that were already exported
+        members = self.redis.zrangebyscore('sorted_ids', min_score, '+inf', start=offset, num=chunk_size,
+                                           withscores=True)
+        if not members:
+            return [], None
+
+        pipeline = self.redis.pipeline(transaction=False)
+        for member, _ in members:
+            pipeline.hmget(member, FIELDS)
+        rows = []
+        for (member, _), (first, last) in zip(members, pipeline.execute()):
+            if first is None and last is None:
+                rows.append(['No data found', 'No data found', member.decode('utf-8')])
+            else:
+                rows.append([(first or b'').decode('utf-8'), (last or b'').decode('utf-8'), member.decode('utf-8')])
+
+        last_score = members[-1][1]
+        ties = 0
+        for _, score in reversed(members):
+            if score != last_score:
+                break
+            ties += 1
+        if ties == len(members) and last_score == min_score:
+            ties += offset
+        return rows, (last_score, ties)
+
     def get_ids(self, start: int = 0, chunk_size: int = 200) -> List[str]:
         ids = self.redis.zrange('sorted_ids', start, start + chunk_size - 1)
         return [id_.decode('utf-8') for id_ in ids]
@@ -101,13 +474,852 @@ class FileMerger:
         rows = [[item['First'], item['Last'], item['ID']] for item in data]
         writer.writerows(rows)
 
-    async def main(self, first_names_file, last_names_file, result_file, chunk_size=100, writer_chunk_size=200):
-        first_names_task = asyncio.create_task(self.process(first_names_file, 'First', chunk_size))
-        last_names_task = asyncio.create_task(self.process(last_names_file, 'Last', chunk_size))
-        await asyncio.gather(first_names_task, last_names_task)
+    def memory_usage(self) -> int:
+        # Sum of MEMORY USAGE over every key of the database, i.e. the footprint of the current layout
+        total = 0
+        keys = 0
+        cursor = 0
+        while True:
+            cursor, batch = self.redis.scan(cursor, count=1000)
+            pipeline = self.redis.pipeline(transaction=False)
+            for key in batch:
+                pipeline.memory_usage(key, samples=0)
+            total += sum(usage or 0 for usage in pipeline.execute())
+            keys += len(batch)
+            if cursor == 0:
+                break
+        logger.info(f"{keys} keys use {total} bytes ({total / 1024 / 1024:.1f} MiB)")
+        return total
+
+    async def main(self, first_names_file, last_names_file, result_file, chunk_size=100, writer_chunk_size=200,
+                   resume=False):
+        # Both files run to the end, so each records its checkpoint, but a failed one leaves no result behind
+        await self.gather(self.process(first_names_file, 'First', chunk_size, resume),
+                          self.process(last_names_file, 'Last', chunk_size, resume))
         self.print_result_file(result_file, writer_chunk_size)
 
+    async def main_incremental(self, first_names_file, last_names_file, result_file, writer_chunk_size=200):
+        # Only chunks that changed since the previous run reach Redis, and only their rows are rewritten
+        (first_ids, first_seen), (last_ids, last_seen) = await self.gather(
+            asyncio.to_thread(self.process_incremental, first_names_file, 'First'),
+            asyncio.to_thread(self.process_incremental, last_names_file, 'Last'))
+        if first_seen and last_seen and os.path.exists(result_file) and detect_compression(result_file) is None:
+            self.patch_result_file(result_file, first_ids | last_ids)
+        else:
+            self.print_result_file(result_file, writer_chunk_size)
+
+    @staticmethod
+    async def gather(*coroutines) -> List:
+        results = await asyncio.gather(*coroutines, return_exceptions=True)
+        for result in results:
+            if isinstance(result, BaseException):
+                raise result
+        return results
+
+    def process_incremental(self, path: str, key: str, chunk_lines: int = DELTA_CHUNK_LINES) -> Tuple[Set[str], bool]:
+        # Returns the IDs whose row may have changed, and whether the file had been ingested before
+        manifest_key = f"{DELTA_KEY_PREFIX}:{key}:{os.path.abspath(path)}"
+        previous = {fingerprint.decode('utf-8') for fingerprint in self.redis.hkeys(manifest_key)}
+        current = {}
+        for fingerprint, start, end in self.fingerprint_chunks(path, chunk_lines):
+            current.setdefault(fingerprint, (start, end))
+        added = [fingerprint for fingerprint in current if fingerprint not in previous]
+        removed = [fingerprint for fingerprint in previous if fingerprint not in current]
+
+        changed_ids = set()
+        with open_file(path, 'rb') as file:
+            lines = []
+            entries = {}
+            position = 0
+            for fingerprint in added:
+                start, end = current[fingerprint]
+                skip(file, start - position)
+                position = end
+                chunk = [line.strip() for line in file.read(end - start).decode('utf-8').splitlines()]
+                ids = [parts[1] for parts in map(str.split, chunk) if len(parts) == 2]
+                lines.extend(chunk)
+                entries[fingerprint] = '\n'.join(ids)
+                changed_ids.update(ids)
+                if len(lines) >= DELTA_BATCH or fingerprint == added[-1]:
+                    if not self.process_data(lines, key):
+                        raise IngestError(f"Failed to ingest changed chunks of {path}")
+                    # Recorded only once their lines are in Redis, so an interrupted run ingests them again
+                    self.redis.hset(manifest_key, mapping=entries)
+                    lines = []
+                    entries = {}
+
+        deleted_ids = set()
+        for ids in self.read_manifest(manifest_key, removed):
+            deleted_ids.update(ids)
+        deleted_ids -= changed_ids
+        if deleted_ids:
+            # IDs still listed by an unchanged chunk, e.g. after an interrupted run, are not deleted
+            for ids in self.read_manifest(manifest_key, [fp for fp in current if fp in previous]):
+                deleted_ids.difference_update(ids)
+        self.delete_fields(sorted(deleted_ids), key)
+        if removed:
+            self.redis.hdel(manifest_key, *removed)
+        logger.info(f"{path}: {len(added)} of {len(current)} chunks changed, {len(deleted_ids)} IDs deleted")
+        return changed_ids | deleted_ids, bool(previous)
+
+    @staticmethod
+    def fingerprint_chunks(path: str, chunk_lines: int = DELTA_CHUNK_LINES) -> List[Tuple[str, int, int]]:
+        # Content-defined chunking: a chunk ends after a line whose CRC is 0 modulo chunk_lines, so an inserted
+        # or deleted line only changes the chunk around it instead of shifting every later boundary
+        chunks = []
+        with open_file(path, 'rb') as file:
+            digest = hashlib.blake2b(digest_size=16)
+            start = position = lines = 0
+            for line in file:
+                digest.update(line)
+                position += len(line)
+                lines += 1
+                if zlib.crc32(line) % chunk_lines == 0 or lines >= DELTA_MAX_CHUNK_LINES:
+                    chunks.append((digest.hexdigest(), start, position))
+                    digest = hashlib.blake2b(digest_size=16)
+                    start = position
+                    lines = 0
+            if position > start:
+                chunks.append((digest.hexdigest(), start, position))
+        return chunks
+
+    def read_manifest(self, manifest_key: str, fingerprints: List[str]) -> Iterator[List[str]]:
+        for start in range(0, len(fingerprints), DELTA_BATCH):
+            for ids in self.redis.hmget(manifest_key, fingerprints[start:start + DELTA_BATCH]):
+                if ids:
+                    yield ids.decode('utf-8').split('\n')
+
+    def delete_fields(self, ids: List[str], key: str) -> None:
+        for start in range(0, len(ids), DELTA_BATCH):
+            self.delete_script(keys=ids[start:start + DELTA_BATCH], args=[key])
+
+    def get_rows_by_ids(self, ids: List[str]) -> Dict[str, List[str]]:
+        # [First, Last, ID] of every ID that still has a field
+        pipeline = self.redis.pipeline(transaction=False)
+        for id_ in ids:
+            pipeline.hmget(id_, FIELDS)
+        rows = {}
+        for id_, (first, last) in zip(ids, pipeline.execute()):
+            if first is not None or last is not None:
+                rows[id_] = [(first or b'').decode('utf-8'), (last or b'').decode('utf-8'), id_]
+        return rows
+
+    def patch_result_file(self, result_file: str, ids: Set[str]) -> None:
+        # The result is sorted by (score, ID), so each affected row is found by binary search and the
+        # untouched bytes in between are copied as they are; the new file replaces the old one atomically
+        rows = self.get_rows_by_ids(list(ids))
+        encoding = locale.getpreferredencoding(False)
+        buffer = io.StringIO()
+        writer = csv.writer(buffer, delimiter=' ')
+        fd, temp_path = tempfile.mkstemp(prefix=f".{os.path.basename(result_file)}.", suffix='.tmp',
+                                         dir=os.path.dirname(os.path.abspath(result_file)))
+        try:
+            with open(result_file, 'rb') as source, open(fd, 'wb', buffering=EXPORT_BUFFER_BYTES) as destination:
+                size = os.fstat(source.fileno()).st_size
+                data = mmap.mmap(source.fileno(), 0, access=mmap.ACCESS_READ) if size else b''
+                try:
+                    position = 0
+                    for id_ in sorted((id_ for id_ in ids if id_score(id_) is not None), key=row_key):
+                        offset = find_row(data, position, row_key(id_), encoding)
+                        copy_range(data, position, offset, destination)
+                        end = data.find(b'\n', offset) + 1 or len(data)
+                        position = end if offset < len(data) and row_id(data[offset:end], encoding) == id_ \
+                            else offset
+                        if id_ in rows:
+                            writer.writerow(rows[id_])
+                            destination.write(buffer.getvalue().encode(encoding))
+                            buffer.seek(0)
+                            buffer.truncate()
+                    copy_range(data, position, len(data), destination)
+                finally:
+                    if size:
+                        data.close()
+            os.replace(temp_path, result_file)
+        except BaseException:
+            os.remove(temp_path)
+            raise
+        logger.info(f"Patched {len(ids)} rows of {result_file}")
+
+
+class CompressedLineReader:
+    """The part of aiofiles' text file interface process() uses, over a file decompressed on a background thread.
+
+    Lines are handed to the event loop a batch per thread hop, and tell() counts decompressed bytes.
+    """
+
+    def __init__(self, path: str, batch_lines: int = 1000):
+        self.path = path
+        self.batch_lines = batch_lines
+        self.encoding = locale.getpreferredencoding(False)
+        self.file = None
+        self.batch = []
+        self.index = 0
+        self.position = 0
+
+    async def __aenter__(self):
+        self.file = await asyncio.to_thread(open_file, self.path, 'rb')
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await asyncio.to_thread(self.file.close)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self) -> str:
+        if self.index >= len(self.batch):
+            self.batch = await asyncio.to_thread(lambda: list(islice(self.file, self.batch_lines)))
+            self.index = 0
+            if not self.batch:
+                raise StopAsyncIteration
+        line = self.batch[self.index]
+        self.index += 1
+        self.position += len(line)
+        return line.decode(self.encoding)
+
+    async def seek(self, offset: int) -> None:
+        # Only called to resume, before anything has been read
+        await asyncio.to_thread(skip, self.file, offset - self.position)
+        self.position = offset
+        self.batch = []
+        self.index = 0
+
+    async def tell(self) -> int:
+        return self.position
+
+
+class AsyncFileMerger(FileMerger):
+    """Ingests through redis.asyncio, keeping up to max_in_flight pipelines per file in flight."""
+
+    def __init__(self, redis_host="127.0.0.1", redis_port=6379, redis_db=0, pipeline_bytes=DEFAULT_PIPELINE_BYTES,
+                 max_connections=DEFAULT_MAX_CONNECTIONS, max_in_flight=DEFAULT_MAX_IN_FLIGHT, redis_client=None,
+                 async_redis_client=None):
+        super().__init__(redis_host, redis_port, redis_db, bulk=True, pipeline_bytes=pipeline_bytes,
+                         redis_client=redis_client)
+        if max_in_flight < 1:
+            raise ValueError(f"max_in_flight must be positive: {max_in_flight}")
+        if async_redis_client is None:
+            # Both files keep up to max_in_flight pipelines each, which may exceed max_connections;
+            # a blocking pool makes the surplus wait for a free connection instead of failing
+            pool = redis.asyncio.BlockingConnectionPool(host=redis_host, port=redis_port, db=redis_db,
+                                                        max_connections=max_connections, timeout=None)
+            async_redis_client = redis.asyncio.Redis(connection_pool=pool)
+        self.async_redis = async_redis_client
+        self.max_in_flight = max_in_flight
+
+    async def process(self, path: str, key: str, chunk_size: int = 100, resume: bool = False) -> int:
+        # Pipelines of one file may complete out of order, so an ID repeated within a file
+        # is not guaranteed to keep its last value, and no checkpoints are recorded.
+        if resume:
+            logger.warning(f"Resume is not supported with the asyncio client, processing {path} from the start")
+        processed = 0
+        started = time.perf_counter()
+        in_flight = set()
+        failed = False
+        try:
+            async with self.open_lines(path) as file:
+                while True:
+                    with READ_SECONDS.time():
+                        lines = await self.read_chunk(file, chunk_size)
+                    if not lines:
+                        break
+                    LINES_TOTAL.inc(len(lines))
+                    if len(in_flight) >= self.max_in_flight:
+                        done, in_flight = await asyncio.wait(in_flight, return_when=asyncio.FIRST_COMPLETED)
+                        if any([task.exception() for task in done]):
+                            failed = True
+                            break
+                    in_flight.add(asyncio.create_task(self.process_data_async(lines, key)))
+                    processed += len(lines)
+        except Exception as e:
+            logger.error(f"An error occurred while processing the file {path}: {e}")
+            failed = True
+        if in_flight:
+            done, _ = await asyncio.wait(in_flight)
+            failed = any([task.exception() for task in done]) or failed
+        self.log_throughput(path, processed, time.perf_counter() - started)
+        if failed:
+            raise IngestError(f"{path} was not fully ingested; without checkpoints it must be processed again")
+        return processed
+
+    async def process_data_async(self, lines: List[str], key: str) -> None:
+        started = time.perf_counter()
+        try:
+            pipeline = self.async_redis.pipeline(transaction=False)
+            for batch in self.batch_by_bytes(self.numeric_records(self.validate_lines(lines)), key):
+                for id_, value in batch:
+                    pipeline.hset(id_, key, value)
+                await self.flush_pipeline_async(pipeline, {id_: id_ for id_, _ in batch})
+            PIPELINE_SECONDS.observe(time.perf_counter() - started)
+        except Exception as e:
+            FAILED_CHUNKS_TOTAL.inc()
+            logger.error(f"An error occurred while processing data: {e}")
+            raise
+
+    @staticmethod
+    async def flush_pipeline_async(pipeline, scores: Dict[str, str]) -> None:
+        if scores:
+            pipeline.zadd('sorted_ids', scores)
+        await pipeline.execute()
+
+    async def close(self) -> None:
+        await self.async_redis.aclose()
+
+
+class ShardedFileMerger(FileMerger):
+    """Spreads IDs over several Redis nodes by consistent hashing; each node keeps its own sorted_ids index."""
+
+    def __init__(self, nodes: Optional[List[str]] = None, pipeline_bytes=DEFAULT_PIPELINE_BYTES, redis_clients=None,
+                 virtual_nodes=DEFAULT_VIRTUAL_NODES, block_bytes=None):
+        if redis_clients is None:
+            redis_clients = [redis.Redis(host=host, port=port, db=db) for host, port, db in map(parse_node, nodes)]
+        if not redis_clients:
+            raise ValueError("At least one shard is required")
+        self.shards = [FileMerger(pipeline_bytes=pipeline_bytes, redis_client=client) for client in redis_clients]
+        self.ring = HashRing(nodes if nodes is not None else [f"shard-{i}" for i in range(len(self.shards))],
+                             virtual_nodes)
+        # Checkpoints live on the first shard and are written only after every shard acknowledged the chunk
+        super().__init__(bulk=False, pipeline_bytes=pipeline_bytes, redis_client=self.shards[0].redis,
+                         block_bytes=block_bytes)
+        self.executor = ThreadPoolExecutor(max_workers=len(self.shards))
+
+    def process_records(self, records: List[Tuple[str, str]], key: str,
+                        checkpoint: Optional[Tuple[str, int]] = None) -> bool:
+        try:
+            futures = [self.executor.submit(self.write_shard, self.shards[shard], shard_records, key)
+                       for shard, shard_records in self.partition(records).items()]
+            for future in futures:
+                future.result()
+            if checkpoint:
+                self.redis.hset(CHECKPOINTS_KEY, *checkpoint)
+            return True
+        except Exception as e:
+            logger.error(f"An error occurred while processing data: {e}")
+            return False
+
+    def partition(self, valid_lines: List[Tuple[str, str]]) -> Dict[int, List[Tuple[str, str]]]:
+        partitions = {}
+        for id_, value in valid_lines:
+            # A non-numeric ID would fail its shard's whole ZADD, so it is dropped here
+            if id_score(id_) is None:
+                continue
+            partitions.setdefault(self.ring.shard(id_), []).append((id_, value))
+        return partitions
+
+    @staticmethod
+    def write_shard(shard: FileMerger, records: List[Tuple[str, str]], key: str) -> None:
+        pipeline = shard.redis.pipeline(transaction=False)
+        for batch in shard.batch_by_bytes(records, key):
+            for id_, value in batch:
+                pipeline.hset(id_, key, value)
+            shard.flush_pipeline(pipeline, {id_: id_ for id_, _ in batch})
+
+    def iter_rows(self, chunk_size: int = 200) -> Iterator[List[List[str]]]:
+        # k-way merge of the shards' pages on the same (score, ID) order a single sorted_ids zset uses
+        shard_rows = [chain.from_iterable(shard.iter_rows(chunk_size)) for shard in self.shards]
+        rows = heapq.merge(*shard_rows, key=lambda row: (float(row[2]), row[2]))
+        while True:
+            page = list(islice(rows, chunk_size))
+            if not page:
+                break
+            yield page
+
+    def get_ids(self, start: int = 0, chunk_size: int = 200) -> List[str]:
+        # The first start + chunk_size IDs overall are among the first start + chunk_size of every shard
+        members = [shard.redis.zrange('sorted_ids', 0, start + chunk_size - 1, withscores=True)
+                   for shard in self.shards]
+        merged = heapq.merge(*members, key=lambda member: (member[1], member[0]))
+        return [member.decode('utf-8') for member, _ in islice(merged, start, start + chunk_size)]
+
+    def get_data_by_ids(self, ids: List[str]) -> List[Dict[str, str]]:
+        data = {}
+        for shard, ids_of_shard in self.group_by_shard(ids).items():
+            for record in self.shards[shard].get_data_by_ids(ids_of_shard):
+                data[record['ID']] = record
+        return [data[id_] for id_ in ids]
+
+    def delete_fields(self, ids: List[str], key: str) -> None:
+        for shard, ids_of_shard in self.group_by_shard(ids).items():
+            self.shards[shard].delete_fields(ids_of_shard, key)
+
+    def get_rows_by_ids(self, ids: List[str]) -> Dict[str, List[str]]:
+        rows = {}
+        for shard, ids_of_shard in self.group_by_shard(ids).items():
+            rows.update(self.shards[shard].get_rows_by_ids(ids_of_shard))
+        return rows
+
+    def group_by_shard(self, ids: List[str]) -> Dict[int, List[str]]:
+        shard_ids = {}
+        for id_ in ids:
+            shard_ids.setdefault(self.ring.shard(id_), []).append(id_)
+        return shard_ids
+
+    def memory_usage(self) -> int:
+        return sum(shard.memory_usage() for shard in self.shards)
+
+
+class HashRing:
+    """Consistent hash ring with virtual nodes, so adding a node only moves about 1/n of the IDs."""
+
+    def __init__(self, nodes: List[str], virtual_nodes: int = DEFAULT_VIRTUAL_NODES):
+        points = sorted((ring_hash(f"{node}#{i}"), shard) for shard, node in enumerate(nodes)
+                        for i in range(virtual_nodes))
+        self.hashes = [point for point, _ in points]
+        self.shards = [shard for _, shard in points]
+
+    def shard(self, id_: str) -> int:
+        return self.shards[bisect.bisect(self.hashes, ring_hash(id_)) % len(self.hashes)]
+
+
+def ring_hash(value: Union[str, bytes]) -> int:
+    if isinstance(value, str):
+        value = value.encode('utf-8')
+    return int.from_bytes(hashlib.md5(value).digest()[:8], 'big')
+
+
+def parse_node(node: str) -> Tuple[str, int, int]:
+    # host[:port][/db]
+    address, _, db = node.partition('/')
+    host, _, port = address.rpartition(':') if ':' in address else (address, '', '')
+    return host or '127.0.0.1', int(port) if port else 6379, int(db) if db else 0
+
+
+class CompactFileMerger(FileMerger):
+    """
+    Stores records in bucket hashes of COMPACT_BUCKET_SIZE integer IDs, each ID mapped to a packed
+    "First<TAB>Last" value, so Redis keeps them listpack encoded. Only bucket numbers go into the
+    compact_buckets zset; IDs are ordered within a bucket on export.
+    """
+
+    def __init__(self, redis_host="127.0.0.1", redis_port=6379, redis_db=0, bucket_size=COMPACT_BUCKET_SIZE,
+                 redis_client=None):
+        super().__init__(redis_host, redis_port, redis_db, redis_client=redis_client)
+        self.bucket_size = bucket_size
+        self.pack_script = self.redis.register_script(PACK_SCRIPT)
+
+    def bucket_key(self, bucket: int) -> str:
+        return f"ids:{bucket}"
+
+    def process_data(self, lines: List[str], key: str, checkpoint: Optional[Tuple[str, int]] = None) -> bool:
+        try:
+            keys = []
+            args = [FIELDS.index(key)]
+            buckets = {}
+            for id_, value in self.validate_lines(lines):
+                bucket = self.parse_id(id_)
+                if bucket is None:
+                    continue
+                keys.append(self.bucket_key(bucket))
+                args.extend((id_, value))
+                buckets[bucket] = bucket
+            pipeline = self.redis.pipeline()
+            if keys:
+                self.pack_script(keys=keys, args=args, client=pipeline)
+                pipeline.zadd('compact_buckets', buckets)
+            if checkpoint:
+                pipeline.hset(CHECKPOINTS_KEY, *checkpoint)
+            pipeline.execute()
+            return True
+        except Exception as e:
+            logger.error(f"An error occurred while processing data: {e}")
+            return False
+
+    def parse_id(self, id_: str) -> Optional[int]:
+        try:
+            return int(id_) // self.bucket_size
+        except ValueError:
+            sampled_logger.warning('invalid_id', f"Non integer id, skipped: {id_}")
+            return None
+
+    def get_ids(self, start: int = 0, chunk_size: int = 200) -> List[str]:
+        ids = (row[2] for rows in self.iter_rows(chunk_size) for row in rows)
+        return list(islice(ids, start, start + chunk_size))
+
+    def get_data_by_ids(self, ids: List[str]) -> List[Dict[str, str]]:
+        pipeline = self.redis.pipeline()
+        for id_ in ids:
+            bucket = self.parse_id(id_)
+            pipeline.hget(self.bucket_key(bucket if bucket is not None else 0), id_)
+        results = []
+        for id_, packed in zip(ids, pipeline.execute()):
+            if packed:
+                first, last = packed.decode('utf-8').split(COMPACT_SEPARATOR)
+                results.append({'ID': id_, 'First': first, 'Last': last})
+            else:
+                results.append({'ID': id_, 'First': 'No data found', 'Last': 'No data found'})
+        return results
+
+    def fetch_rows(self, min_score: float, offset: int,
+                   chunk_size: int = 200) -> Tuple[List[List[str]], Optional[Tuple[float, int]]]:
+        # Buckets have unique scores, so the cursor is the last bucket with an offset of one
+        buckets = self.redis.zrangebyscore('compact_buckets', min_score, '+inf', start=offset,
+                                           num=max(1, chunk_size // self.bucket_size), withscores=True)
+        if not buckets:
+            return [], None
+
+        pipeline = self.redis.pipeline(transaction=False)
+        for bucket, _ in buckets:
+            pipeline.hgetall(self.bucket_key(int(bucket)))
+        rows = []
+        for packed_records in pipeline.execute():
+            records = sorted((int(id_), id_.decode('utf-8'), packed) for id_, packed in packed_records.items())
+            for _, id_, packed in records:
+                first, last = packed.decode('utf-8').split(COMPACT_SEPARATOR)
+                rows.append([first, last, id_])
+        return rows, (buckets[-1][1], 1)
+
+
+def id_score(id_: Union[str, bytes]) -> Optional[float]:
+    # Mirrors the sorted_ids zset: IDs are ordered by numeric score, then by the ID itself
+    text = id_.decode('ascii', 'replace') if isinstance(id_, bytes) else id_
+    score = parse_score(text)
+    if score is None:
+        sampled_logger.warning('invalid_id', f"Invalid id, skipped: {text}")
+    return score
+
+
+def parse_score(text: str) -> Optional[float]:
+    # The scores Redis accepts from strtod, which float() is more lenient than: ASCII digits only, no NaN or digit
+    # separators, and no overflow to infinity or underflow to zero, which strtod reports as out of range
+    if not text.isascii() or '_' in text:
+        return None
+    try:
+        score = float(text)
+    except ValueError:
+        return None
+    if math.isnan(score):
+        return None
+    if math.isinf(score) and text.lstrip('+-').lower() not in ('inf', 'infinity'):
+        return None
+    if score == 0 and any(digit in '123456789' for digit in text.lower().partition('e')[0]):
+        return None
+    return score
+
+
+def row_key(id_: str) -> Tuple[float, str]:
+    return float(id_), id_
+
+
+def row_id(row: bytes, encoding: str) -> str:
+    return row.rstrip(b'\r\n').rsplit(b' ', 1)[-1].decode(encoding)
+
+
+def copy_range(data, start: int, end: int, destination) -> None:
+    # Bounded writes from a view of the map: slicing the mmap itself would copy the whole range into memory
+    with memoryview(data) as view:
+        for chunk_start in range(start, end, EXPORT_BUFFER_BYTES):
+            destination.write(view[chunk_start:min(chunk_start + EXPORT_BUFFER_BYTES, end)])
+
+
+def find_row(data, start: int, key: Tuple[float, str], encoding: str) -> int:
+    # Offset of the first row at or after start (a row boundary) whose key is not below key
+    low, high = start, len(data)
+    while low < high:
+        middle = (low + high) // 2
+        row_start = max(data.rfind(b'\n', 0, middle) + 1, low)
+        row_end = data.find(b'\n', row_start) + 1 or len(data)
+        if row_key(row_id(data[row_start:row_end], encoding)) < key:
+            low = row_end
+        else:
+            high = row_start
+    return low
+
+
+class LocalFileMerger(FileMerger):
+    """Base of the engines that merge within this process: no Redis, so no checkpoints or delta manifests."""
+
+    def __init__(self):
+        self.redis = None
+        self.bulk = False
+        self.pipeline_bytes = DEFAULT_PIPELINE_BYTES
+        self.block_bytes = None
+
+    def load_checkpoint(self, checkpoint_field: str) -> int:
+        # In-process state does not outlive the run that built it, so there is nothing to resume from
+        logger.warning(f"Resume is not supported by {type(self).__name__}, "
+                       f"processing {checkpoint_field} from the start")
+        return 0
+
+    async def main_incremental(self, first_names_file, last_names_file, result_file, writer_chunk_size=200):
+        raise NotImplementedError(f"Incremental mode needs the Redis backend, not {type(self).__name__}")
+
+
+class MemoryFileMerger(LocalFileMerger):
+    """Joins both files in a dict of [First, Last] lists; no Redis server is involved."""
+
+    def __init__(self):
+        super().__init__()
+        self.records = {}
+        self.sorted_ids = None
+
+    def process_data(self, lines: List[str], key: str, checkpoint: Optional[Tuple[str, int]] = None) -> bool:
+        index = FIELDS.index(key)
+        for id_, value in self.validate_lines(lines):
+            if id_score(id_) is None:
+                continue
+            self.records.setdefault(id_, ['', ''])[index] = value
+        self.sorted_ids = None
+        return True
+
+    def get_ids(self, start: int = 0, chunk_size: int = 200) -> List[str]:
+        if self.sorted_ids is None:
+            self.sorted_ids = sorted(self.records, key=lambda id_: (float(id_), id_))
+        return self.sorted_ids[start:start + chunk_size]
+
+    def get_data_by_ids(self, ids: List[str]) -> List[Dict[str, str]]:
+        results = []
+        for id_ in ids:
+            record = self.records.get(id_)
+            if record:
+                results.append({'ID': id_, 'First': record[0], 'Last': record[1]})
+            else:
+                results.append({'ID': id_, 'First': 'No data found', 'Last': 'No data found'})
+        return results
+
+    def iter_rows(self, chunk_size: int = 200) -> Iterator[List[List[str]]]:
+        start = 0
+        while True:
+            ids = self.get_ids(start, chunk_size)
+            if not ids:
+                break
+            yield [[*self.records[id_], id_] for id_ in ids]
+            start += chunk_size
+
+    def memory_usage(self) -> int:
+        # Shallow sizes of the dict, its ID strings, the [First, Last] lists and their values
+        total = sys.getsizeof(self.records)
+        for id_, record in self.records.items():
+            total += sys.getsizeof(id_) + sys.getsizeof(record) + sum(map(sys.getsizeof, record))
+        logger.info(f"{len(self.records)} records use {total} bytes ({total / 1024 / 1024:.1f} MiB)")
+        return total
+
+
+class DiskFileMerger(LocalFileMerger):
+    """Sorts each input by ID into bounded on-disk runs and merge-joins them on export."""
+
+    def __init__(self, memory_limit: int = DEFAULT_RUN_BYTES, temp_dir: Optional[str] = None):
+        super().__init__()
+        self.memory_limit = memory_limit
+        self.temp_dir = temp_dir
+        self.lock = threading.Lock()
+        self.sequence = count()
+        self.buffers = {key: [] for key in FIELDS}
+        self.buffer_bytes = {key: 0 for key in FIELDS}
+        self.runs = {key: [] for key in FIELDS}
+        self.exported = False
+
+    def process_data(self, lines: List[str], key: str, checkpoint: Optional[Tuple[str, int]] = None) -> bool:
+        with self.lock:
+            buffer = self.buffers[key]
+            for id_, value in self.validate_lines(lines):
+                score = id_score(id_)
+                if score is None:
+                    continue
+                # The sequence number keeps the last write of a repeated ID, like HSET would
+                buffer.append((score, id_, next(self.sequence), value))
+                self.buffer_bytes[key] += len(id_) + len(value) + 100
+            if self.buffer_bytes[key] >= self.memory_limit:
+                self.spill(key)
+        return True
+
+    def spill(self, key: str) -> None:
+        buffer = self.buffers[key]
+        buffer.sort()
+        fd, run_path = tempfile.mkstemp(prefix='filemerger-', suffix='.run', dir=self.temp_dir)
+        with open(fd, 'w', encoding='utf-8', newline='\n') as file:
+            for _, id_, sequence, value in buffer:
+                file.write(f"{id_}\t{sequence}\t{value}\n")
+        self.runs[key].append(run_path)
+        self.buffers[key] = []
+        self.buffer_bytes[key] = 0
+
+    @staticmethod
+    def read_run(run_path: str) -> Iterator[Tuple[float, str, int, str]]:
+        with open(run_path, 'r', encoding='utf-8', newline='\n') as file:
+            for line in file:
+                id_, sequence, value = line[:-1].split('\t')
+                yield float(id_), id_, int(sequence), value
+
+    def iter_field(self, key: str) -> Iterator[Tuple[float, str, str]]:
+        self.buffers[key].sort()
+        streams = [self.read_run(run_path) for run_path in self.runs[key]] + [iter(self.buffers[key])]
+        previous = None
+        for score, id_, _, value in heapq.merge(*streams):
+            if previous is not None and previous[1] != id_:
+                yield previous
+            previous = (score, id_, value)
+        if previous is not None:
+            yield previous
+
+    def get_ids(self, start: int = 0, chunk_size: int = 200) -> List[str]:
+        # Each call scans the merged runs up to the requested page; export streams them once through iter_rows
+        with self.lock:
+            return [id_ for id_, _, _ in islice(self.iter_records(), start, start + chunk_size)]
+
+    def get_data_by_ids(self, ids: List[str]) -> List[Dict[str, str]]:
+        wanted = set(ids)
+        found = {}
+        with self.lock:
+            for id_, first, last in self.iter_records():
+                if id_ in wanted:
+                    found[id_] = {'ID': id_, 'First': first, 'Last': last}
+                    if len(found) == len(wanted):
+                        break
+        return [found.get(id_) or {'ID': id_, 'First': 'No data found', 'Last': 'No data found'} for id_ in ids]
+
+    def iter_records(self) -> Iterator[Tuple[str, str, str]]:
+        # Merge-join of the two ID-sorted streams; an ID missing from one file gets an empty value
+        if self.exported:
+            raise RuntimeError("The sorted runs are deleted once exported; ingest the files again to read them")
+        firsts = self.iter_field('First')
+        lasts = self.iter_field('Last')
+        first = next(firsts, None)
+        last = next(lasts, None)
+        while first is not None or last is not None:
+            if last is None or (first is not None and first[:2] < last[:2]):
+                yield first[1], first[2], ''
+                first = next(firsts, None)
+            elif first is None or last[:2] < first[:2]:
+                yield last[1], '', last[2]
+                last = next(lasts, None)
+            else:
+                yield first[1], first[2], last[2]
+                first = next(firsts, None)
+                last = next(lasts, None)
+
+    def iter_rows(self, chunk_size: int = 200) -> Iterator[List[List[str]]]:
+        try:
+            page = []
+            for id_, first, last in self.iter_records():
+                page.append([first, last, id_])
+                if len(page) >= chunk_size:
+                    yield page
+                    page = []
+            if page:
+                yield page
+        finally:
+            self.delete_runs()
+
+    def memory_usage(self) -> int:
+        # Estimated bytes of the records buffered until the next spill; spilled runs are only on disk
+        with self.lock:
+            total = sum(self.buffer_bytes.values())
+            runs = sum(len(run_paths) for run_paths in self.runs.values())
+        logger.info(f"Buffers use {total} bytes ({total / 1024 / 1024:.1f} MiB), {runs} runs on disk")
+        return total
+
+    def delete_runs(self) -> None:
+        for key in FIELDS:
+            for run_path in self.runs[key]:
+                if os.path.exists(run_path):
+                    os.remove(run_path)
+            self.runs[key] = []
+            self.buffers[key] = []
+            self.buffer_bytes[key] = 0
+        self.exported = True
+
+
+def create_merger(backend: str = BACKEND_REDIS, layout: str = LAYOUT_STANDARD, **kwargs) -> FileMerger:
+    if backend == BACKEND_REDIS and layout == LAYOUT_COMPACT:
+        return CompactFileMerger(**kwargs)
+    if backend == BACKEND_MEMORY:
+        return MemoryFileMerger()
+    if backend == BACKEND_DISK:
+        return DiskFileMerger(**kwargs)
+    if backend == BACKEND_REDIS:
+        return FileMerger(**kwargs)
+    raise ValueError(f"Unknown backend: {backend}")
+
+
+async def run(merger: FileMerger, first_names_file: str, last_names_file: str, result_file: str, chunk_size: int,
+              writer_chunk_size: int, report_memory: bool = False, resume: bool = False,
+              incremental: bool = False) -> None:
+    started = time.perf_counter()
+    try:
+        if incremental:
+            await merger.main_incremental(first_names_file, last_names_file, result_file, writer_chunk_size)
+        else:
+            await merger.main(first_names_file, last_names_file, result_file, chunk_size, writer_chunk_size, resume)
+        logger.info(f"{type(merger).__name__} finished in {time.perf_counter() - started:.2f}s")
+        if report_memory:
+            merger.memory_usage()
+    finally:
+        if isinstance(merger, AsyncFileMerger):
+            await merger.close()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument('first_names_file', type=str, nargs='?', default='names.txt')
+    parser.add_argument('last_names_file', type=str, nargs='?', default='surnames.txt')
+    parser.add_argument('result_file', type=str, nargs='?', default='result.txt')
+    parser.add_argument('--chunk-size', type=int, default=100, help='lines read from a file per batch')
+    parser.add_argument('--writer-chunk-size', type=int, default=200, help='ids exported per page')
+    parser.add_argument('--backend', choices=BACKENDS, default=BACKEND_REDIS,
+                        help='where records are joined: Redis, process memory, or sorted runs on disk')
+    parser.add_argument('--layout', choices=LAYOUTS, default=LAYOUT_STANDARD,
+                        help='Redis layout: one hash per ID, or bucketed hashes with packed values')
+    parser.add_argument('--report-memory', action='store_true',
+                        help='log the memory used by the chosen layout or engine after the merge')
+    parser.add_argument('--resume', action='store_true',
+                        help='continue each input after its last committed chunk instead of from the start')
+    parser.add_argument('--run-bytes', type=int, default=DEFAULT_RUN_BYTES,
+                        help='memory used per input before the disk backend spills a sorted run')
+    parser.add_argument('--bulk', action='store_true',
+                        help='ingest through non-transactional pipelines sized by --pipeline-bytes')
+    parser.add_argument('--pipeline-bytes', type=int, default=DEFAULT_PIPELINE_BYTES)
+    parser.add_argument('--async-client', action='store_true',
+                        help='ingest with redis.asyncio and overlapping pipelines instead of worker threads')
+    parser.add_argument('--max-in-flight', type=int, default=DEFAULT_MAX_IN_FLIGHT,
+                        help='pipelines per file awaiting a reply before reading pauses')
+    parser.add_argument('--block-bytes', type=int, default=None,
+                        help='ingest by parsing mmapped blocks of this many bytes instead of line by line')
+    parser.add_argument('--compare-readers', action='store_true',
+                        help='time the line and block readers on the first input and report the speedup')
+    parser.add_argument('--shard', type=str, action='append',
+                        help='host[:port][/db] of a Redis node to consistent-hash IDs onto; may be repeated')
+    parser.add_argument('--incremental', action='store_true',
+                        help='ingest only chunks that changed since the last run and patch the existing result file')
+    parser.add_argument('--metrics-file', type=str, default=None,
+                        help='write per-chunk read/validate/pipeline metrics here in Prometheus text format')
+    args = parser.parse_args()
+    if args.shard and (args.backend != BACKEND_REDIS or args.layout == LAYOUT_COMPACT or args.async_client):
+        parser.error("--shard only supports the standard Redis layout with the threaded client")
+    if args.incremental and (args.backend != BACKEND_REDIS or args.layout == LAYOUT_COMPACT or args.async_client
+                             or args.resume):
+        parser.error("--incremental only supports the standard Redis layout with the threaded client, without --resume")
+
+    if args.block_bytes and (args.backend != BACKEND_REDIS or args.layout == LAYOUT_COMPACT or args.async_client):
+        parser.error("--block-bytes only supports the standard Redis layout with the threaded client")
+
+    if args.compare_readers:
+        rates = FileMerger.benchmark_readers(args.first_names_file, args.chunk_size,
+                                             args.block_bytes or DEFAULT_BLOCK_BYTES)
+        logger.info(f"Readers: lines {rates[READER_LINES]:.0f} lines/s, blocks {rates[READER_BLOCKS]:.0f} lines/s, "
+                    f"speedup {rates[READER_BLOCKS] / max(rates[READER_LINES], 1e-9):.1f}x")
+
+    if args.backend == BACKEND_MEMORY:
+        merger = create_merger(BACKEND_MEMORY)
+    elif args.backend == BACKEND_DISK:
+        merger = create_merger(BACKEND_DISK, memory_limit=args.run_bytes)
+    elif args.shard:
+        merger = ShardedFileMerger(args.shard, pipeline_bytes=args.pipeline_bytes, block_bytes=args.block_bytes)
+    elif args.async_client:
+        merger = AsyncFileMerger(pipeline_bytes=args.pipeline_bytes, max_in_flight=args.max_in_flight)
+    elif args.layout == LAYOUT_COMPACT:
+        merger = create_merger(BACKEND_REDIS, LAYOUT_COMPACT)
+    else:
+        merger = create_merger(BACKEND_REDIS, bulk=args.bulk, pipeline_bytes=args.pipeline_bytes,
+                               block_bytes=args.block_bytes)
+    try:
+        asyncio.run(run(merger, args.first_names_file, args.last_names_file, args.result_file, args.chunk_size,
+                        args.writer_chunk_size, args.report_memory, args.resume, args.incremental))
+    except IngestError as e:
+        logger.error(f"{args.result_file} was not written: {e}")
+        sys.exit(1)
+    finally:
+        export(args.metrics_file)
+
 
 if __name__ == "__main__":
-    merger = FileMerger()
-    asyncio.run(merger.main("names.txt", "surnames.txt", "result.txt", 100, 200))
+    main()
@@ -1,54 +1,360 @@
 import argparse
+import asyncio
+import ctypes
+import ctypes.util
+import errno
+import glob
 import logging
 import os
+import select
 import shutil
+import signal
+import struct
+import sys
+import tempfile
+import threading
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext, contextmanager, asynccontextmanager
 from multiprocessing import Lock
-from typing import List
+from typing import List, Optional, NamedTuple, Iterable, Dict, Iterator, Tuple, AsyncIterator
 
 from filelock import FileLock, Timeout
 
+from tasks.Metrics import REGISTRY, SampledLogger, counter, export, histogram
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
+sampled_logger = SampledLogger(logger)
+
+COPY_CHUNK_BYTES = 64 * 1024 * 1024
+DEFAULT_BATCH_WORKERS = 8
+DEFAULT_ASYNC_CONCURRENCY = 256
+DEFAULT_LOCK_PATH = os.path.join(tempfile.gettempdir(), 'filemover.lock')
+DEFAULT_LOCK_STRIPES = 1024
+LOCK_TIMEOUT = 10
+LOCK_POLL_SECONDS = 0.005
+DEFAULT_DEBOUNCE_SECONDS = 0.25
+
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+WATCH_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+INOTIFY_EVENT = struct.Struct('iIII')
+
+LOCK_WAIT_SECONDS = histogram('file_mover_lock_wait_seconds', 'Time spent acquiring the locks of one move')
+LOCK_TIMEOUTS_TOTAL = counter('file_mover_lock_timeouts_total', 'Moves abandoned after the lock timeout')
+COPY_SECONDS = histogram('file_mover_copy_seconds', 'Time to copy and fsync one file across devices')
+COPIED_BYTES_TOTAL = counter('file_mover_copied_bytes_total', 'Bytes copied by cross-device moves')
+MOVES_TOTAL = counter('file_mover_moves_total', 'Files moved')
+
+
+class MoveResult(NamedTuple):
+    source: str
+    destination: Optional[str]
+    size: int
+    seconds: float
+    error: Optional[str] = None
+
+
+class LockManager:
+    """
+    Striped path locks. A path hashes to one of `stripes` one-byte fcntl ranges of a single,
+    never deleted lock file, which excludes other processes; a threading.Lock per stripe
+    excludes other threads, since fcntl locks are held per process. Stripes are always taken
+    in ascending order, so locking a source and a destination cannot deadlock. Use a single
+    manager per process and lock file, as two managers in one process do not exclude each other.
+    """
+
+    def __init__(self, lock_path: str = DEFAULT_LOCK_PATH, stripes: int = DEFAULT_LOCK_STRIPES):
+        self.lock_path = lock_path
+        self.stripes = stripes
+        self.thread_locks = [threading.Lock() for _ in range(stripes)]
+        self.file_locks = None if fcntl else [FileLock(f"{lock_path}.{stripe}") for stripe in range(stripes)]
+        self.fd = None
+        self.open_lock = threading.Lock()
+        self.stats_lock = threading.Lock()
+        self.acquisitions = 0
+        self.timeouts = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def stripe(self, path: str) -> int:
+        # crc32 rather than hash() so every process maps a path to the same stripe
+        return zlib.crc32(os.path.abspath(path).encode('utf-8', 'surrogateescape')) % self.stripes
+
+    @contextmanager
+    def acquire(self, *paths: str, timeout: float = LOCK_TIMEOUT) -> Iterator[None]:
+        started = time.perf_counter()
+        deadline = started + timeout
+        acquired = []
+        try:
+            for stripe in sorted({self.stripe(path) for path in paths}):
+                if not self.thread_locks[stripe].acquire(timeout=max(deadline - time.perf_counter(), 0)):
+                    raise Timeout(self.lock_path)
+                try:
+                    self.lock_stripe(stripe, deadline)
+                except BaseException:
+                    self.thread_locks[stripe].release()
+                    raise
+                acquired.append(stripe)
+        except Timeout:
+            self.release(acquired)
+            self.record_wait(time.perf_counter() - started, timed_out=True)
+            raise
+        except BaseException:
+            self.release(acquired)
+            raise
+        self.record_wait(time.perf_counter() - started)
+        try:
+            yield
+        finally:
+            self.release(acquired)
+
+    @asynccontextmanager
+    async def acquire_async(self, *paths: str, timeout: float = LOCK_TIMEOUT) -> AsyncIterator[None]:
+        # Same stripes and ordering as acquire, but polls all-or-nothing so the event loop never blocks
+        started = time.perf_counter()
+        stripes = sorted({self.stripe(path) for path in paths})
+        while not self.try_acquire(stripes):
+            if time.perf_counter() - started >= timeout:
+                self.record_wait(time.perf_counter() - started, timed_out=True)
+                raise Timeout(self.lock_path)
+            await asyncio.sleep(LOCK_POLL_SECONDS)
+        self.record_wait(time.perf_counter() - started)
+        try:
+            yield
+        finally:
+            self.release(stripes)
 
-
-def move_file(file_path: str, dest_folder: str, lock: Lock):
+    def try_acquire(self, stripes: List[int]) -> bool:
+        acquired = []
+        try:
+            for stripe in stripes:
+                if not self.thread_locks[stripe].acquire(blocking=False):
+                    break
+                try:
+                    locked = self.try_lock_stripe(stripe)
+                except BaseException:
+                    self.thread_locks[stripe].release()
+                    raise
+                if not locked:
+                    self.thread_locks[stripe].release()
+                    break
+                acquired.append(stripe)
+            else:
+                return True
+        except BaseException:
+            self.release(acquired)
+            raise
+        self.release(acquired)
+        return False
+
+    def lock_stripe(self, stripe: int, deadline: float) -> None:
+        if self.file_locks is not None:
+            self.file_locks[stripe].acquire(timeout=max(deadline - time.perf_counter(), 0))
+            return
+        while not self.try_lock_stripe(stripe):
+            if time.perf_counter() >= deadline:
+                raise Timeout(self.lock_path)
+            time.sleep(LOCK_POLL_SECONDS)
+
+    def try_lock_stripe(self, stripe: int) -> bool:
+        if self.file_locks is not None:
+            try:
+                self.file_locks[stripe].acquire(timeout=0)
+                return True
+            except Timeout:
+                return False
+        # Opened outside the try: a lock file that cannot be opened is an error, not contention
+        fd = self.lock_fd()
+        try:
+            fcntl.lockf(fd, fcntl.LOCK_EX | fcntl.LOCK_NB, 1, stripe, os.SEEK_SET)
+            return True
+        except OSError as e:
+            if e.errno in (errno.EACCES, errno.EAGAIN):
+                return False
+            raise
+
+    def unlock_stripe(self, stripe: int) -> None:
+        if self.file_locks is not None:
+            self.file_locks[stripe].release()
+        else:
+            fcntl.lockf(self.fd, fcntl.LOCK_UN, 1, stripe, os.SEEK_SET)
+
+    def release(self, stripes: List[int]) -> None:
+        for stripe in reversed(stripes):
+            self.unlock_stripe(stripe)
+            self.thread_locks[stripe].release()
+        stripes.clear()
+
+    def lock_fd(self) -> int:
+        # One descriptor for the manager's lifetime: closing any descriptor of the file drops all fcntl locks
+        with self.open_lock:
+            if self.fd is None:
+                self.fd = os.open(self.lock_path, os.O_RDWR | os.O_CREAT, 0o666)
+            return self.fd
+
+    def record_wait(self, seconds: float, timed_out: bool = False) -> None:
+        if timed_out:
+            LOCK_TIMEOUTS_TOTAL.inc()
+        else:
+            LOCK_WAIT_SECONDS.observe(seconds)
+        with self.stats_lock:
+            if timed_out:
+                self.timeouts += 1
+                return
+            self.acquisitions += 1
+            self.total_wait += seconds
+            self.max_wait = max(self.max_wait, seconds)
+
+    def stats(self) -> Dict[str, float]:
+        with self.stats_lock:
+            return {
+                'acquisitions': self.acquisitions,
+                'timeouts': self.timeouts,
+                'total_wait_seconds': self.total_wait,
+                'mean_wait_seconds': self.total_wait / self.acquisitions if self.acquisitions else 0.0,
+                'max_wait_seconds': self.max_wait,
+            }
+
+
+default_lock_manager_lock = threading.Lock()
+default_lock_manager_instance = None
+
+
+def default_lock_manager() -> LockManager:
+    global default_lock_manager_instance
+    with default_lock_manager_lock:
+        if default_lock_manager_instance is None:
+            default_lock_manager_instance = LockManager()
+        return default_lock_manager_instance
+
+
+def move_file(file_path: str, dest_folder: str, lock: Optional[Lock] = None,
+              lock_manager: Optional[LockManager] = None) -> Optional[str]:
     check_file_exists(file_path)
     dest_path = validate_destination_path(dest_folder, file_path)
+    lock_manager = lock_manager if lock_manager is not None else default_lock_manager()
 
-    source_lock_file_path = get_lock_file_path(file_path)
-    dest_lock_file_path = get_lock_file_path(dest_path)
+    sampled_logger.info('moving', f"Moving file {file_path} to {dest_folder}")
 
-    logger.info(f"Moving file {file_path} to {dest_folder}")
-
-    with lock:
-        source_lock = FileLock(source_lock_file_path)
-        dest_lock = FileLock(dest_lock_file_path)
+    with lock if lock is not None else nullcontext():
         try:
-            logger.info("Acquiring locks for files.")
-            with source_lock.acquire(timeout=10):
-                logger.info(f"Lock acquired for: {file_path}")
-                try:
-                    backup = backup_file(file_path)
-
-                    with dest_lock.acquire(timeout=10):
-                        logging.info(f"Destination lock acquired for {file_path}")
-
-                        try:
-                            shutil.move(file_path, dest_path)
-                            print(dest_path)
-                            logging.info(f"Successfully moved {file_path} to {dest_path}")
-                        except Exception as e:
-                            logging.error(f"Failed to move {file_path}: {e}")
-                            restore_file(file_path, backup)
+            with lock_manager.acquire(file_path, dest_path):
+                sampled_logger.info('locked', f"Locks acquired for {file_path} and {dest_path}")
 
+                # The source is only removed once the destination is durable, so no backup is needed
+                try:
+                    # Re-checked under the locks: another mover may have won the race since validation
+                    check_file_exists(file_path)
+                    check_file_does_not_exists(dest_path)
+                    move(file_path, dest_path)
+                    print(dest_path)
+                    return dest_path
                 except Exception as e:
-                    logging.error(f"Failed to backup/restore {file_path}: {e}")
+                    logging.error(f"Failed to move {file_path}: {e}")
 
         except Timeout:
             logging.error(f"Timeout while trying to acquire lock for {file_path}")
-        finally:
-            release_locks([source_lock, dest_lock])
-            delete_files([source_lock_file_path, dest_lock_file_path])
+        except OSError as e:
+            logging.error(f"Failed to lock {file_path} using {lock_manager.lock_path}: {e}")
+    return None
+
+
+def move_files(file_paths: Iterable[str], dest_folder: str, workers: int = DEFAULT_BATCH_WORKERS,
+               lock_manager: Optional[LockManager] = None) -> List[MoveResult]:
+    # Moves are I/O bound, so a thread pool is enough; the lock manager still excludes other processes
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(lambda file_path: timed_move(file_path, dest_folder, lock_manager), file_paths))
+
+
+def timed_move(file_path: str, dest_folder: str, lock_manager: Optional[LockManager] = None) -> MoveResult:
+    started = time.perf_counter()
+    try:
+        size = os.path.getsize(file_path)
+        destination = move_file(file_path, dest_folder, lock_manager=lock_manager)
+        error = None if destination else "move failed"
+    except Exception as e:
+        size = 0
+        destination = None
+        error = str(e)
+    return MoveResult(file_path, destination, size, time.perf_counter() - started, error)
+
+
+async def move_file_async(file_path: str, dest_folder: str, lock_manager: Optional[LockManager] = None) -> Optional[str]:
+    # Locks are polled on the event loop; the rename, copy and fsync calls run in worker threads
+    check_file_exists(file_path)
+    dest_path = await asyncio.to_thread(validate_destination_path, dest_folder, file_path)
+    lock_manager = lock_manager if lock_manager is not None else default_lock_manager()
+
+    try:
+        async with lock_manager.acquire_async(file_path, dest_path):
+            try:
+                check_file_exists(file_path)
+                check_file_does_not_exists(dest_path)
+                await asyncio.to_thread(move, file_path, dest_path)
+                return dest_path
+            except Exception as e:
+                logging.error(f"Failed to move {file_path}: {e}")
+    except Timeout:
+        logging.error(f"Timeout while trying to acquire lock for {file_path}")
+    except OSError as e:
+        logging.error(f"Failed to lock {file_path} using {lock_manager.lock_path}: {e}")
+    return None
+
+
+async def move_files_async(file_paths: Iterable[str], dest_folder: str,
+                           concurrency: int = DEFAULT_ASYNC_CONCURRENCY,
+                           lock_manager: Optional[LockManager] = None) -> List[MoveResult]:
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def timed_move_async(file_path: str) -> MoveResult:
+        async with semaphore:
+            started = time.perf_counter()
+            try:
+                size = os.path.getsize(file_path)
+                destination = await move_file_async(file_path, dest_folder, lock_manager)
+                error = None if destination else "move failed"
+            except Exception as e:
+                size = 0
+                destination = None
+                error = str(e)
+            return MoveResult(file_path, destination, size, time.perf_counter() - started, error)
+
+    return list(await asyncio.gather(*(timed_move_async(file_path) for file_path in file_paths)))
+
+
+def collect_sources(pattern: Optional[str] = None, directory: Optional[str] = None,
+                    manifest: Optional[str] = None) -> List[str]:
+    sources = []
+    if pattern:
+        sources.extend(path for path in sorted(glob.glob(pattern)) if os.path.isfile(path))
+    if directory:
+        sources.extend(entry.path for entry in sorted(os.scandir(directory), key=lambda entry: entry.name)
+                       if entry.is_file() and not entry.name.endswith('.lock'))
+    if manifest:
+        with open(manifest, 'r') as file:
+            sources.extend(line.strip() for line in file if line.strip())
+    return sources
+
+
+def report_results(results: List[MoveResult], elapsed: float) -> None:
+    moved = [result for result in results if result.error is None]
+    for result in results:
+        if result.error is not None:
+            logging.error(f"Failed to move {result.source}: {result.error}")
+    moved_bytes = sum(result.size for result in moved)
+    logging.info(f"Moved {len(moved)}/{len(results)} files ({moved_bytes / 1024 / 1024:.1f} MiB) in {elapsed:.2f}s: "
+                 f"{len(moved) / max(elapsed, 1e-9):.1f} files/s, {moved_bytes / 1024 / 1024 / max(elapsed, 1e-9):.1f} MiB/s")
 
 
 def check_file_exists(file_path: str) -> None:
@@ -63,7 +369,7 @@ def check_file_does_not_exists(file_path: str) -> None:
 
 def create_if_not_exists(destination_directory: str) -> None:
     if not os.path.exists(destination_directory):
-        os.makedirs(destination_directory)
+        os.makedirs(destination_directory, exist_ok=True)
 
 
 def get_lock_file_path(file_path: str) -> str:
@@ -99,13 +405,93 @@ def restore_file(file_path: str, content: bytes) -> None:
 
 def move(source_path: str, destination_path: str) -> None:
     try:
-        shutil.move(source_path, destination_path)
-        logging.info(f"Successfully moved {source_path} to {destination_path}")
+        atomic_move(source_path, destination_path)
+        MOVES_TOTAL.inc()
+        sampled_logger.info('moved', f"Successfully moved {source_path} to {destination_path}")
     except Exception as e:
         logging.error(f"Failed to move {source_path}: {e}")
         raise Exception(f"Failed to move {source_path}: {e}")
 
 
+def atomic_move(source_path: str, destination_path: str) -> None:
+    destination_dir = os.path.dirname(os.path.abspath(destination_path))
+    if is_same_device(source_path, destination_dir):
+        # Bind mounts of one filesystem share st_dev, yet rename(2) still fails across them with EXDEV
+        try:
+            os.rename(source_path, destination_path)
+            fsync_directory(destination_dir)
+            return
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+
+    # Cross-device: copy into a temp file next to the destination, make it durable, rename it into
+    # place and only then unlink the source. A crash leaves either the intact source or both copies.
+    temp_path = copy_to_temp_file(source_path, destination_dir)
+    try:
+        os.rename(temp_path, destination_path)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+    fsync_directory(destination_dir)
+    os.remove(source_path)
+    fsync_directory(os.path.dirname(os.path.abspath(source_path)))
+
+
+def is_same_device(source_path: str, destination_dir: str) -> bool:
+    return os.stat(source_path).st_dev == os.stat(destination_dir).st_dev
+
+
+def copy_to_temp_file(source_path: str, destination_dir: str) -> str:
+    fd, temp_path = tempfile.mkstemp(prefix=f".{os.path.basename(source_path)}.", suffix='.tmp', dir=destination_dir)
+    try:
+        with COPY_SECONDS.time(), open(source_path, 'rb') as source, open(fd, 'wb') as destination:
+            copy_file_data(source.fileno(), destination.fileno())
+            os.fsync(destination.fileno())
+            COPIED_BYTES_TOTAL.inc(destination.tell())
+        shutil.copystat(source_path, temp_path)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+    return temp_path
+
+
+def copy_file_data(source_fd: int, destination_fd: int) -> None:
+    # Kernel-side copy: copy_file_range first, sendfile where it is unsupported, plain reads as a last resort
+    try:
+        while os.copy_file_range(source_fd, destination_fd, COPY_CHUNK_BYTES):
+            pass
+        return
+    except (AttributeError, OSError):
+        pass
+    try:
+        offset = os.lseek(destination_fd, 0, os.SEEK_CUR)
+        os.lseek(source_fd, offset, os.SEEK_SET)
+        while os.sendfile(destination_fd, source_fd, None, COPY_CHUNK_BYTES):
+            pass
+        return
+    except (AttributeError, OSError):
+        pass
+    offset = os.lseek(destination_fd, 0, os.SEEK_CUR)
+    os.lseek(source_fd, offset, os.SEEK_SET)
+    while True:
+        data = memoryview(os.read(source_fd, COPY_CHUNK_BYTES))
+        if not data:
+            break
+        while data:
+            data = data[os.write(destination_fd, data):]
+
+
+def fsync_directory(path: str) -> None:
+    if os.name == 'nt':
+        return
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
 def delete_files(files: List[str]) -> None:
     for file in files:
         if os.path.exists(file):
@@ -127,15 +513,228 @@ def validate_destination_path(dest_folder: str, file_path: str) -> str:
     return dest_path
 
 
+class InotifyWatcher:
+    """Reports files written to or moved into the watched directories, using inotify through libc."""
+
+    def __init__(self, directories: List[str]):
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.directories = {}
+        for directory in directories:
+            wd = libc.inotify_add_watch(self.fd, os.fsencode(directory), WATCH_MASK)
+            if wd < 0:
+                os.close(self.fd)
+                raise OSError(ctypes.get_errno(), f"inotify_add_watch failed for {directory}")
+            self.directories[wd] = directory
+
+    def read_events(self, timeout: float) -> List[Tuple[str, bool]]:
+        # (path, finished) pairs; finished is False while a file may still be written to
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return []
+        events = []
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return events
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = INOTIFY_EVENT.unpack_from(data, offset)
+            offset += INOTIFY_EVENT.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b'\0'))
+            offset += length
+            if mask & IN_Q_OVERFLOW:
+                logging.warning("inotify queue overflowed, rescanning watched directories")
+                events.extend((path, True) for path in scan_directories(self.directories.values()))
+            elif name and wd in self.directories:
+                events.append((os.path.join(self.directories[wd], name), bool(mask & (IN_CLOSE_WRITE | IN_MOVED_TO))))
+        return events
+
+    def close(self) -> None:
+        os.close(self.fd)
+
+
+class PollingWatcher:
+    """Fallback for platforms without inotify: a file is finished once its size and mtime stop changing."""
+
+    def __init__(self, directories: List[str], interval: float = DEFAULT_DEBOUNCE_SECONDS):
+        self.directories = directories
+        self.interval = interval
+        self.seen = {}
+        self.changed = set()
+
+    def read_events(self, timeout: float) -> List[Tuple[str, bool]]:
+        # A change is reported as unfinished, and the first poll that finds it unchanged as finished
+        time.sleep(min(timeout, self.interval))
+        events = []
+        seen = {}
+        changed = set()
+        for path in scan_directories(self.directories):
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            seen[path] = (stat.st_size, stat.st_mtime_ns)
+            if self.seen.get(path) != seen[path]:
+                changed.add(path)
+                events.append((path, False))
+            elif path in self.changed:
+                events.append((path, True))
+        self.seen = seen
+        self.changed = changed
+        return events
+
+    def close(self) -> None:
+        pass
+
+
+def scan_directories(directories: Iterable[str]) -> List[str]:
+    paths = []
+    for directory in directories:
+        paths.extend(entry.path for entry in os.scandir(directory) if entry.is_file() and is_movable(entry.name))
+    return paths
+
+
+def is_movable(name: str) -> bool:
+    # Hidden files are usually in-flight temp files of the producer
+    return not name.startswith('.') and not name.endswith('.lock')
+
+
+class MoveDaemon:
+    """
+    Long-running mover: watches source directories and moves each file once it has been
+    finished (closed after writing or renamed in) and left untouched for `debounce` seconds.
+    Moves run in-process on a small thread pool through move_file.
+    """
+
+    def __init__(self, source_dirs: List[str], dest_folder: str, debounce: float = DEFAULT_DEBOUNCE_SECONDS,
+                 workers: int = DEFAULT_BATCH_WORKERS, lock_manager: Optional[LockManager] = None,
+                 use_inotify: bool = True):
+        self.source_dirs = source_dirs
+        self.dest_folder = dest_folder
+        self.debounce = debounce
+        self.workers = workers
+        self.lock_manager = lock_manager
+        self.use_inotify = use_inotify
+        self.stop_event = threading.Event()
+        self.ready = threading.Event()
+        self.pending = {}
+        self.in_progress = set()
+
+    def create_watcher(self):
+        if self.use_inotify and sys.platform.startswith('linux'):
+            try:
+                return InotifyWatcher(self.source_dirs)
+            except OSError as e:
+                logging.warning(f"inotify unavailable, falling back to polling: {e}")
+        return PollingWatcher(self.source_dirs, self.debounce)
+
+    def run(self) -> None:
+        watcher = self.create_watcher()
+        # Files that landed while the daemon was down are moved after one debounce period
+        due = time.monotonic() + self.debounce
+        for path in scan_directories(self.source_dirs):
+            self.pending[path] = due
+        self.ready.set()
+        logging.info(f"Watching {', '.join(self.source_dirs)} for files to move to {self.dest_folder}")
+        try:
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                while not self.stop_event.is_set():
+                    self.dispatch_due(executor)
+                    for path, finished in watcher.read_events(self.next_timeout()):
+                        if not is_movable(os.path.basename(path)) or path in self.in_progress:
+                            continue
+                        # Unfinished files wait for their close; any new write restarts the debounce
+                        self.pending[path] = time.monotonic() + self.debounce if finished else None
+        finally:
+            watcher.close()
+
+    def next_timeout(self) -> float:
+        due = [due for due in self.pending.values() if due is not None]
+        if not due:
+            return self.debounce
+        return max(0.0, min(min(due) - time.monotonic(), self.debounce))
+
+    def dispatch_due(self, executor: ThreadPoolExecutor) -> None:
+        now = time.monotonic()
+        for path in [path for path, due in self.pending.items() if due is not None and due <= now]:
+            del self.pending[path]
+            if not os.path.exists(path):
+                continue
+            self.in_progress.add(path)
+            executor.submit(self.move, path)
+
+    def move(self, path: str) -> MoveResult:
+        try:
+            result = timed_move(path, self.dest_folder, self.lock_manager)
+            if result.error is not None:
+                logging.error(f"Failed to move {path}: {result.error}")
+            return result
+        finally:
+            self.in_progress.discard(path)
+
+    def stop(self) -> None:
+        self.stop_event.set()
+
+
 def main() -> None:
     parser = argparse.ArgumentParser()
-    parser.add_argument('source_file', type=str)
+    parser.add_argument('source_file', type=str, nargs='?')
     parser.add_argument('dest_folder', type=str)
+    parser.add_argument('--glob', type=str, help='move every file matching this pattern')
+    parser.add_argument('--dir', type=str, help='move every file directly inside this directory')
+    parser.add_argument('--manifest', type=str, help='move every file listed in this file, one path per line')
+    parser.add_argument('--workers', type=int, default=DEFAULT_BATCH_WORKERS, help='concurrent moves in batch mode')
+    parser.add_argument('--async-io', action='store_true',
+                        help='run batch moves on an event loop with --workers concurrent moves')
+    parser.add_argument('--lock-file', type=str, default=DEFAULT_LOCK_PATH,
+                        help='lock file shared by every mover that must exclude each other')
+    parser.add_argument('--lock-stripes', type=int, default=DEFAULT_LOCK_STRIPES)
+    parser.add_argument('--watch', type=str, action='append',
+                        help='run as a daemon moving files that land in this directory; may be repeated')
+    parser.add_argument('--debounce', type=float, default=DEFAULT_DEBOUNCE_SECONDS,
+                        help='seconds a finished file must stay untouched before the daemon moves it')
+    parser.add_argument('--metrics-file', type=str, default=None,
+                        help='write lock wait and copy metrics here in Prometheus text format on exit')
+    parser.add_argument('--metrics-port', type=int, default=None,
+                        help='serve the same metrics over HTTP on this port while running')
     args = parser.parse_args()
     source_file = args.source_file
     dest_folder = args.dest_folder
+    lock_manager = LockManager(args.lock_file, args.lock_stripes)
+
+    if args.metrics_port is not None:
+        REGISTRY.serve(args.metrics_port)
 
-    move_file(source_file, dest_folder, Lock())
+    try:
+        if args.watch:
+            daemon = MoveDaemon(args.watch, dest_folder, args.debounce, args.workers, lock_manager)
+            signal.signal(signal.SIGTERM, lambda *_: daemon.stop())
+            try:
+                daemon.run()
+            except KeyboardInterrupt:
+                pass
+            return
+
+        if args.glob or args.dir or args.manifest:
+            sources = collect_sources(args.glob, args.dir, args.manifest)
+            if source_file:
+                sources.insert(0, source_file)
+            started = time.perf_counter()
+            if args.async_io:
+                results = asyncio.run(move_files_async(sources, dest_folder, args.workers, lock_manager))
+            else:
+                results = move_files(sources, dest_folder, args.workers, lock_manager)
+            report_results(results, time.perf_counter() - started)
+            logging.info(f"Lock waits: {lock_manager.stats()}")
+            return
+
+        if source_file is None:
+            parser.error("a source file or one of --glob, --dir, --manifest is required")
+        move_file(source_file, dest_folder, lock_manager=lock_manager)
+    finally:
+        export(args.metrics_file)
 
 
 if __name__ == "__main__":
@@ -1,11 +1,52 @@
 import argparse
+import bisect
+import csv
+import heapq
+import locale
 import logging
+import mmap
+import os
+import sys
+import tempfile
+import time
+import weakref
 from collections import Counter
-from typing import List
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice, repeat
+from typing import List, Iterable, Iterator, Optional, Tuple, Dict, Union
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from tasks.CompressedIO import EXTENSIONS, detect_compression, open_file
+from tasks.Metrics import counter, export, histogram
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+DEFAULT_MEMORY_LIMIT = 64 * 1024 * 1024
+MAX_MERGE_FAN_IN = 256
+
+BACKEND_COUNTER = 'counter'
+BACKEND_NUMPY = 'numpy'
+BACKENDS = (BACKEND_COUNTER, BACKEND_NUMPY)
+BATCH_SIZE = 4096
+BENCHMARK_SAMPLE_LINES = 1_000_000
+
+GROUP_COUNTS = 'counts'
+GROUP_LINES = 'lines'
+GROUP_MODES = (GROUP_COUNTS, GROUP_LINES)
+
+INDEX_SUFFIX = '.idx'
+DEFAULT_INDEX_EVERY = 256
+
+CANONICALIZE_SECONDS = histogram('lines_sorter_canonicalize_seconds',
+                                 f'Time to canonicalize one batch of up to {BATCH_SIZE} lines')
+SORT_SECONDS = histogram('lines_sorter_sort_seconds', 'Time to sort one in-memory list or run of keys')
+LINES_TOTAL = counter('lines_sorter_lines_total', 'Lines canonicalized')
+
 
 class LinesSorter:
 
@@ -33,40 +74,515 @@ class LinesSorter:
         return sorted_characters
 
     @staticmethod
-    def sort_lines(file_path: str) -> List[str]:
-        sorted_lines = []
+    def sort_letters_batch(words: List[str]) -> List[str]:
+        # Counting sort over the bytes of all ASCII words of the batch at once:
+        # one 256-bin histogram per word, expanded back into sorted bytes.
+        if np is None:
+            raise ImportError("numpy is required for the 'numpy' backend")
+        results = [None] * len(words)
+        ascii_indexes = []
+        for i, word in enumerate(words):
+            if word.isascii():
+                ascii_indexes.append(i)
+            else:
+                # Non-ASCII text keeps code point order through the Counter path
+                results[i] = LinesSorter.sort_letters(word)
+        if not ascii_indexes:
+            return results
+
+        ascii_words = [words[i] for i in ascii_indexes]
+        lengths = np.fromiter(map(len, ascii_words), dtype=np.int64, count=len(ascii_words))
+        codes = np.frombuffer(''.join(ascii_words).encode('ascii'), dtype=np.uint8)
+        word_ids = np.repeat(np.arange(len(ascii_words), dtype=np.int64), lengths)
+        counts = np.bincount(word_ids * 256 + codes, minlength=len(ascii_words) * 256)
+        sorted_codes = np.repeat(np.tile(np.arange(256, dtype=np.uint8), len(ascii_words)), counts)
+        text = sorted_codes.tobytes().decode('ascii')
+
+        ends = np.cumsum(lengths).tolist()
+        start = 0
+        for i, end in zip(ascii_indexes, ends):
+            results[i] = text[start:end]
+            start = end
+        return results
+
+    @staticmethod
+    def canonical_keys(lines: Iterable[str], backend: str = BACKEND_COUNTER) -> Iterator[str]:
+        # Batched for both backends so that timing costs one observation per batch rather than per line
+        if backend not in BACKENDS:
+            raise ValueError(f"Unknown backend: {backend}")
+        lines = iter(lines)
+        while True:
+            batch = [line.strip() for line in islice(lines, BATCH_SIZE)]
+            if not batch:
+                break
+            with CANONICALIZE_SECONDS.time():
+                if backend == BACKEND_NUMPY:
+                    keys = LinesSorter.sort_letters_batch(batch)
+                else:
+                    keys = [LinesSorter.sort_letters(line) for line in batch]
+            LINES_TOTAL.inc(len(batch))
+            yield from keys
+
+    @staticmethod
+    def benchmark_backends(file_path: str, sample_lines: int = BENCHMARK_SAMPLE_LINES) -> Dict[str, float]:
+        with open_file(file_path, 'r') as file:
+            lines = list(islice(file, sample_lines))
+        timings = {}
+        for backend in BACKENDS:
+            start = time.perf_counter()
+            for _ in LinesSorter.canonical_keys(lines, backend):
+                pass
+            timings[backend] = time.perf_counter() - start
+        return timings
+
+    @staticmethod
+    def sort_lines(file_path: str, memory_limit: Optional[int] = None, workers: int = 1,
+                   backend: str = BACKEND_COUNTER) -> Iterable[str]:
+        # Byte ranges cannot be cut out of a compressed stream, so compressed input is sorted by this process
+        # while a background thread decompresses it
+        if workers > 1 and detect_compression(file_path) is None:
+            return LinesSorter.sort_lines_parallel(file_path, workers, memory_limit, backend)
+        if memory_limit is not None:
+            return LinesSorter.sort_lines_external(file_path, memory_limit, backend)
         try:
-            with open(file_path, 'r') as file:
-                for line in file:
-                    sorted_lines.append(LinesSorter.sort_letters(line.strip()))
+            with open_file(file_path, 'r') as file:
+                sorted_lines = list(LinesSorter.canonical_keys(file, backend))
             # O(n log n), where n is not large
-            return sorted(sorted_lines)
+            with SORT_SECONDS.time():
+                return sorted(sorted_lines)
+        except FileNotFoundError:
+            logging.error(f"File not found error: {file_path}")
+        except Exception as e:
+            logging.error(f"An error occurred while reading the file '{file_path}': {e}")
+
+    @staticmethod
+    def sort_lines_external(file_path: str, memory_limit: int = DEFAULT_MEMORY_LIMIT,
+                            backend: str = BACKEND_COUNTER) -> Iterator[str]:
+        # The whole input is consumed into sorted runs before anything is returned,
+        # so the output file may safely be the input file.
+        run_paths = []
+        try:
+            with open_file(file_path, 'r') as file:
+                run_paths = LinesSorter.spill_runs(LinesSorter.canonical_keys(file, backend), memory_limit)
+            return MergedRuns(run_paths)
+        except FileNotFoundError:
+            logging.error(f"File not found error: {file_path}")
+        except Exception as e:
+            logging.error(f"An error occurred while reading the file '{file_path}': {e}")
+        LinesSorter.delete_runs(run_paths)
+
+    @staticmethod
+    def sort_lines_parallel(file_path: str, workers: int, memory_limit: Optional[int] = None,
+                            backend: str = BACKEND_COUNTER) -> Iterable[str]:
+        # Each worker canonicalizes and sorts its own byte range; the sorted ranges are then merged.
+        run_paths = []
+        try:
+            ranges = LinesSorter.chunk_boundaries(file_path, workers)
+            starts = [start for start, _ in ranges]
+            ends = [end for _, end in ranges]
+            encoding = locale.getpreferredencoding(False)
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                if memory_limit is None:
+                    chunks = list(executor.map(LinesSorter.sort_range, repeat(file_path), starts, ends,
+                                               repeat(encoding), repeat(backend)))
+                    return list(heapq.merge(*chunks))
+                worker_limit = max(1, memory_limit // workers)
+                for paths in executor.map(LinesSorter.sort_range_to_runs, repeat(file_path), starts, ends,
+                                          repeat(encoding), repeat(worker_limit), repeat(backend)):
+                    run_paths.extend(paths)
+            return MergedRuns(run_paths)
+        except FileNotFoundError:
+            logging.error(f"File not found error: {file_path}")
+        except Exception as e:
+            logging.error(f"An error occurred while reading the file '{file_path}': {e}")
+        LinesSorter.delete_runs(run_paths)
+
+    @staticmethod
+    def chunk_boundaries(file_path: str, chunks: int) -> List[Tuple[int, int]]:
+        # Split the file into roughly equal byte ranges, each ending right after a newline
+        size = os.path.getsize(file_path)
+        boundaries = [0]
+        with open(file_path, 'rb') as file:
+            for i in range(1, chunks):
+                offset = max(size * i // chunks, boundaries[-1], 1)
+                if offset >= size:
+                    break
+                # Reading from the byte before the offset keeps a boundary that already follows a newline
+                file.seek(offset - 1)
+                file.readline()
+                boundaries.append(file.tell())
+        boundaries.append(size)
+        return [(start, end) for start, end in zip(boundaries, boundaries[1:]) if start < end]
+
+    @staticmethod
+    def read_range(file_path: str, start: int, end: int, encoding: str) -> Iterator[str]:
+        # Yields the same lines text mode would for this byte range, including '\r' and '\r\n' newlines
+        with open(file_path, 'rb') as file:
+            file.seek(start)
+            position = start
+            for raw_line in file:
+                if position >= end:
+                    break
+                position += len(raw_line)
+                line = raw_line.decode(encoding)
+                if '\r' in line:
+                    line = line.replace('\r\n', '\n').replace('\r', '\n')
+                    if line.endswith('\n'):
+                        line = line[:-1]
+                    yield from line.split('\n')
+                else:
+                    yield line
+
+    @staticmethod
+    def sort_range(file_path: str, start: int, end: int, encoding: str,
+                   backend: str = BACKEND_COUNTER) -> List[str]:
+        keys = list(LinesSorter.canonical_keys(LinesSorter.read_range(file_path, start, end, encoding), backend))
+        with SORT_SECONDS.time():
+            keys.sort()
+        return keys
+
+    @staticmethod
+    def sort_range_to_runs(file_path: str, start: int, end: int, encoding: str, memory_limit: int,
+                           backend: str = BACKEND_COUNTER) -> List[str]:
+        keys = LinesSorter.canonical_keys(LinesSorter.read_range(file_path, start, end, encoding), backend)
+        return LinesSorter.spill_runs(keys, memory_limit)
+
+    @staticmethod
+    def spill_runs(keys: Iterable[str], memory_limit: int) -> List[str]:
+        run_paths = []
+        run = []
+        run_size = 0
+        try:
+            for key in keys:
+                run.append(key)
+                run_size += sys.getsizeof(key)
+                if run_size >= memory_limit:
+                    run_paths.append(LinesSorter.write_run(run))
+                    run = []
+                    run_size = 0
+            if run or not run_paths:
+                run_paths.append(LinesSorter.write_run(run))
+        except Exception:
+            LinesSorter.delete_runs(run_paths)
+            raise
+        return run_paths
+
+    @staticmethod
+    def write_run(run: List[str]) -> str:
+        with SORT_SECONDS.time():
+            run.sort()
+        fd, run_path = tempfile.mkstemp(prefix='linessorter-', suffix='.run')
+        with open(fd, 'w', encoding='utf-8', newline='\n') as file:
+            for key in run:
+                file.write(key + '\n')
+        return run_path
+
+    @staticmethod
+    def read_run(file) -> Iterator[str]:
+        for line in file:
+            yield line[:-1]
+
+    @staticmethod
+    def merge_runs(run_paths: List[str]) -> Iterator[str]:
+        try:
+            # Cascade merges so that no more than MAX_MERGE_FAN_IN runs are open at once
+            while len(run_paths) > MAX_MERGE_FAN_IN:
+                group, run_paths = run_paths[:MAX_MERGE_FAN_IN], run_paths[MAX_MERGE_FAN_IN:]
+                run_paths.append(LinesSorter.merge_into_run(group))
+
+            files = [open(path, 'r', encoding='utf-8', newline='\n') for path in run_paths]
+            try:
+                yield from heapq.merge(*(LinesSorter.read_run(file) for file in files))
+            finally:
+                for file in files:
+                    file.close()
+        finally:
+            LinesSorter.delete_runs(run_paths)
+
+    @staticmethod
+    def merge_into_run(run_paths: List[str]) -> str:
+        fd, merged_path = tempfile.mkstemp(prefix='linessorter-', suffix='.run')
+        with open(fd, 'w', encoding='utf-8', newline='\n') as file:
+            for key in LinesSorter.merge_runs(run_paths):
+                file.write(key + '\n')
+        return merged_path
+
+    @staticmethod
+    def delete_runs(run_paths: List[str]) -> None:
+        for run_path in run_paths:
+            if os.path.exists(run_path):
+                os.remove(run_path)
+
+    @staticmethod
+    def group_lines(file_path: str, mode: str = GROUP_COUNTS,
+                    backend: str = BACKEND_COUNTER) -> Dict[str, Union[int, List[str]]]:
+        # Single streaming pass; each distinct key is stored once as a dict key,
+        # mapped either to its count or to the original lines that produced it.
+        if mode not in GROUP_MODES:
+            raise ValueError(f"Unknown group mode: {mode}")
+        groups = Counter() if mode == GROUP_COUNTS else {}
+        try:
+            with open_file(file_path, 'r') as file:
+                while True:
+                    batch = [line.strip() for line in islice(file, BATCH_SIZE)]
+                    if not batch:
+                        break
+                    keys = LinesSorter.canonical_keys(batch, backend)
+                    if mode == GROUP_COUNTS:
+                        groups.update(keys)
+                        continue
+                    for key, line in zip(keys, batch):
+                        group = groups.get(key)
+                        if group is None:
+                            groups[key] = [line]
+                        else:
+                            group.append(line)
+            return groups
         except FileNotFoundError:
             logging.error(f"File not found error: {file_path}")
         except Exception as e:
             logging.error(f"An error occurred while reading the file '{file_path}': {e}")
 
     @staticmethod
-    def write_to_file(lines: List[str], output_file_path: str) -> None:
+    def write_groups(groups: Dict[str, Union[int, List[str]]], output_file_path: str) -> None:
+        # One tab separated row per key in sorted order: key, count and, for line groups, the lines
+        try:
+            with open_file(output_file_path, 'w', newline='') as file:
+                writer = csv.writer(file, delimiter='\t', lineterminator='\n')
+                for key in sorted(groups):
+                    group = groups[key]
+                    if isinstance(group, int):
+                        writer.writerow([key, group])
+                    else:
+                        writer.writerow([key, len(group), *group])
+            logging.info(f"Grouped keys exported into '{output_file_path}'")
+        except Exception as e:
+            logging.error(f"An error occurred while writing to the file '{output_file_path}': {e}")
+
+    @staticmethod
+    def write_to_file(lines: Iterable[str], output_file_path: str, index_every: Optional[int] = None) -> None:
+        # Closing lines deletes the spilled runs of an external sort even when writing fails before reading them
         try:
-            with open(output_file_path, 'w') as file:
-                for line in lines:
-                    file.write(line + '\n')
+            if index_every:
+                LinesSorter.write_indexed(lines, output_file_path, index_every)
+            else:
+                with open_file(output_file_path, 'w') as file:
+                    for line in lines:
+                        file.write(line + '\n')
             logging.info(f"Sorted line exported into '{output_file_path}'")
         except Exception as e:
             logging.error(f"An error occurred while writing to the file '{output_file_path}': {e}")
+        finally:
+            close = getattr(lines, 'close', None)
+            if close is not None:
+                close()
+
+    @staticmethod
+    def write_indexed(lines: Iterable[str], output_file_path: str, every: int = DEFAULT_INDEX_EVERY) -> None:
+        # Writes the same bytes as text mode would, counting them to record the offset of the first occurrence
+        # of a key once at least every lines have passed since the previous entry
+        if every < 1:
+            raise ValueError(f"Index interval must be positive: {every}")
+        if os.path.splitext(output_file_path)[1].lower() in EXTENSIONS:
+            raise ValueError("A compressed output cannot be memory mapped, so it cannot be indexed")
+        encoding = locale.getpreferredencoding(False)
+        keys = []
+        offsets = []
+        offset = 0
+        since = every
+        previous = None
+        with open(output_file_path, 'wb') as file:
+            for line in lines:
+                if since >= every and line != previous:
+                    keys.append(line)
+                    offsets.append(offset)
+                    since = 0
+                data = (line + '\n').encode(encoding)
+                file.write(data)
+                offset += len(data)
+                since += 1
+                previous = line
+        KeyIndex.write(output_file_path + INDEX_SUFFIX, keys, offsets, every, offset, encoding)
+
+    @staticmethod
+    def query_keys(file_path: str, words: Iterable[str]) -> List[Tuple[str, str, int]]:
+        # Each word is canonicalized first; canonicalizing a key again leaves it unchanged
+        try:
+            with KeyIndex(file_path) as index:
+                results = []
+                for word in words:
+                    key = LinesSorter.sort_letters(word.strip())
+                    results.append((word, key, index.count(key)))
+                return results
+        except FileNotFoundError as e:
+            logging.error(f"File not found error: {e.filename}")
+        except Exception as e:
+            logging.error(f"An error occurred while querying the file '{file_path}': {e}")
+
+
+class MergedRuns:
+    """Iterator over the merged keys of sorted run files, which are deleted once it is closed or collected."""
+
+    def __init__(self, run_paths: List[str]):
+        self.merged = LinesSorter.merge_runs(run_paths)
+        # merge_runs only deletes the runs once it has been started, so an unread iterator needs this backstop
+        self.finalizer = weakref.finalize(self, LinesSorter.delete_runs, list(run_paths))
+
+    def __iter__(self) -> 'MergedRuns':
+        return self
+
+    def __next__(self) -> str:
+        return next(self.merged)
+
+    def close(self) -> None:
+        self.merged.close()
+        self.finalizer()
+
+
+class KeyIndex:
+    """Sparse sidecar index over a sorted keys file, answering membership and count queries through mmap."""
+
+    def __init__(self, file_path: str, index_path: Optional[str] = None):
+        self.file_path = file_path
+        self.index_path = index_path or file_path + INDEX_SUFFIX
+        self.keys, self.offsets, self.every, size, self.encoding = KeyIndex.read(self.index_path)
+        self.file = open(file_path, 'rb')
+        try:
+            if os.fstat(self.file.fileno()).st_size != size:
+                raise ValueError(f"Index '{self.index_path}' is stale: it was built for {size} bytes")
+            # mmap refuses empty files, and bytes offers the same find and slicing
+            self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ) if size else b''
+        except Exception:
+            self.file.close()
+            raise
+
+    @staticmethod
+    def write(index_path: str, keys: List[str], offsets: List[int], every: int, size: int, encoding: str) -> None:
+        # A header of interval, data size and encoding, then one offset and key per entry.
+        # Keys never contain a newline, and the offset comes first, so tabs in keys are harmless.
+        directory = os.path.dirname(os.path.abspath(index_path))
+        fd, temp_path = tempfile.mkstemp(prefix=f".{os.path.basename(index_path)}.", suffix='.tmp', dir=directory)
+        try:
+            with open(fd, 'w', encoding='utf-8', newline='\n') as file:
+                file.write(f"{every}\t{size}\t{encoding}\n")
+                for offset, key in zip(offsets, keys):
+                    file.write(f"{offset}\t{key}\n")
+            os.replace(temp_path, index_path)
+        except BaseException:
+            os.remove(temp_path)
+            raise
+
+    @staticmethod
+    def read(index_path: str) -> Tuple[List[str], List[int], int, int, str]:
+        with open(index_path, 'r', encoding='utf-8', newline='\n') as file:
+            every, size, encoding = file.readline().rstrip('\n').split('\t')
+            keys = []
+            offsets = []
+            for line in file:
+                offset, key = line[:-1].split('\t', 1)
+                offsets.append(int(offset))
+                keys.append(key)
+        return keys, offsets, int(every), int(size), encoding
+
+    def count(self, key: str) -> int:
+        # Entries sit on the first occurrence of a key, so every copy of key lies between entry i and entry i + 1
+        i = bisect.bisect_right(self.keys, key) - 1
+        if i < 0:
+            return 0
+        line = key.encode(self.encoding) + b'\n'
+        if self.keys[i] == key:
+            position = self.offsets[i]
+        else:
+            end = self.offsets[i + 1] if i + 1 < len(self.offsets) else len(self.map)
+            position = self.map.find(b'\n' + line, max(self.offsets[i] - 1, 0), end)
+            if position < 0:
+                return 0
+            position += 1
+        return self.run_length(position, line)
+
+    def run_length(self, position: int, line: bytes) -> int:
+        # Copies of a key are identical lines, so the k-th copy starts k * len(line) bytes into the run;
+        # gallop then bisect over k to count a run of any length in O(log count) probes
+        pattern = b'\n' + line
+        width = len(line)
+
+        def matches(k: int) -> bool:
+            start = position + k * width - 1
+            return self.map[start:start + width + 1] == pattern
+
+        low, high = 0, 1
+        while matches(high):
+            low, high = high, high * 2
+        while high - low > 1:
+            middle = (low + high) // 2
+            if matches(middle):
+                low = middle
+            else:
+                high = middle
+        return high
+
+    def __contains__(self, key: str) -> bool:
+        return self.count(key) > 0
+
+    def close(self) -> None:
+        if isinstance(self.map, mmap.mmap):
+            self.map.close()
+        self.file.close()
+
+    def __enter__(self) -> 'KeyIndex':
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
 
 
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('input_file', type=str)
     parser.add_argument('output_file', type=str, nargs='?')
+    parser.add_argument('--memory-limit-mb', type=int, default=None,
+                        help='sort in external memory, spilling sorted runs of at most this size to disk')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of processes canonicalizing and sorting chunks of the input in parallel')
+    parser.add_argument('--backend', choices=BACKENDS, default=BACKEND_COUNTER,
+                        help='canonicalization backend; numpy sorts ASCII lines in batches and needs numpy installed')
+    parser.add_argument('--compare-backends', action='store_true',
+                        help='time both backends on a sample of the input and report the speedup')
+    parser.add_argument('--group', choices=GROUP_MODES, default=None,
+                        help='write one row per distinct key with its count, or with its count and original lines')
+    parser.add_argument('--index-every', type=int, default=None,
+                        help=f'also write a sparse index of every Nth key to OUTPUT{INDEX_SUFFIX} for --query '
+                             f'(e.g. {DEFAULT_INDEX_EVERY})')
+    parser.add_argument('--query', nargs='+', default=None, metavar='WORD',
+                        help='look up the anagram keys of these words in an indexed sorted INPUT_FILE and print '
+                             'word, key and count per line')
+    parser.add_argument('--metrics-file', type=str, default=None,
+                        help='write canonicalize and sort timings here in Prometheus text format')
     args = parser.parse_args()
 
     input_file = args.input_file
     output_file = args.output_file if args.output_file else input_file
+    memory_limit = args.memory_limit_mb * 1024 * 1024 if args.memory_limit_mb else None
+
+    if args.query:
+        for word, key, count in LinesSorter.query_keys(input_file, args.query) or []:
+            print(f"{word}\t{key}\t{count}")
+        return
+
+    if args.index_every is not None and (args.group or args.index_every < 1):
+        parser.error('--index-every needs a positive interval and cannot be combined with --group')
+
+    if args.compare_backends:
+        timings = LinesSorter.benchmark_backends(input_file)
+        logging.info(f"Canonicalization: counter {timings[BACKEND_COUNTER]:.3f}s, numpy {timings[BACKEND_NUMPY]:.3f}s, "
+                     f"speedup {timings[BACKEND_COUNTER] / max(timings[BACKEND_NUMPY], 1e-9):.1f}x")
 
-    LinesSorter.write_to_file(LinesSorter.sort_lines(input_file), output_file)
+    if args.group:
+        LinesSorter.write_groups(LinesSorter.group_lines(input_file, args.group, args.backend), output_file)
+    else:
+        LinesSorter.write_to_file(LinesSorter.sort_lines(input_file, memory_limit, args.workers, args.backend),
+                                  output_file, args.index_every)
+    export(args.metrics_file)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,209 @@
+import bisect
+import logging
+import os
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple, Union
+
+# Prometheus' default latency buckets, extended downwards for per-chunk timings
+DEFAULT_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+                   10.0)
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+DEFAULT_SAMPLE_BURST = 10
+DEFAULT_SAMPLE_INTERVAL = 10.0
+
+
+class Counter:
+    """Monotonically increasing value, safe to increment from several threads."""
+
+    def __init__(self, name: str, help_text: str = ''):
+        self.name = name
+        self.help_text = help_text
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def inc(self, amount: Union[int, float] = 1) -> None:
+        with self.lock:
+            self.value += amount
+
+    def samples(self) -> List[Tuple[str, Union[int, float]]]:
+        with self.lock:
+            return [(self.name, self.value)]
+
+
+class Histogram:
+    """Distribution of observed values over fixed upper bounds; time() doubles as a timer."""
+
+    def __init__(self, name: str, help_text: str = '', buckets: Sequence[float] = DEFAULT_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.bounds = sorted(buckets)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.sum = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, value: float) -> None:
+        index = bisect.bisect_left(self.bounds, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += value
+
+    @contextmanager
+    def time(self) -> Iterator[None]:
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started)
+
+    @property
+    def count(self) -> int:
+        with self.lock:
+            return sum(self.counts)
+
+    def samples(self) -> List[Tuple[str, Union[int, float]]]:
+        with self.lock:
+            counts = list(self.counts)
+            total = self.sum
+        samples = []
+        cumulative = 0
+        for bound, bucket_count in zip(self.bounds, counts):
+            cumulative += bucket_count
+            samples.append((f'{self.name}_bucket{{le="{format_value(bound)}"}}', cumulative))
+        cumulative += counts[-1]
+        samples.append((f'{self.name}_bucket{{le="+Inf"}}', cumulative))
+        samples.append((f'{self.name}_sum', total))
+        samples.append((f'{self.name}_count', cumulative))
+        return samples
+
+
+class MetricsRegistry:
+    """Named counters and histograms, rendered in the Prometheus text exposition format."""
+
+    def __init__(self):
+        self.metrics: Dict[str, Union[Counter, Histogram]] = {}
+        self.lock = threading.Lock()
+
+    def counter(self, name: str, help_text: str = '') -> Counter:
+        return self.get_or_create(Counter, name, help_text)
+
+    def histogram(self, name: str, help_text: str = '', buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+        return self.get_or_create(Histogram, name, help_text, buckets)
+
+    def get_or_create(self, metric_type, name: str, *args):
+        with self.lock:
+            metric = self.metrics.get(name)
+            if metric is None:
+                metric = self.metrics[name] = metric_type(name, *args)
+            elif not isinstance(metric, metric_type):
+                raise ValueError(f"Metric {name} is already registered as a {type(metric).__name__}")
+            return metric
+
+    def to_prometheus(self) -> str:
+        with self.lock:
+            metrics = sorted(self.metrics.values(), key=lambda metric: metric.name)
+        lines = []
+        for metric in metrics:
+            if metric.help_text:
+                lines.append(f"# HELP {metric.name} {metric.help_text}")
+            lines.append(f"# TYPE {metric.name} {'counter' if isinstance(metric, Counter) else 'histogram'}")
+            lines.extend(f"{name} {format_value(value)}" for name, value in metric.samples())
+        return '\n'.join(lines) + '\n'
+
+    def write_prometheus(self, path: str) -> None:
+        # Written to a temp file and renamed, so a scraper or node_exporter never reads a partial file
+        directory = os.path.dirname(os.path.abspath(path))
+        fd, temp_path = tempfile.mkstemp(prefix=f".{os.path.basename(path)}.", suffix='.tmp', dir=directory)
+        try:
+            with open(fd, 'w') as file:
+                file.write(self.to_prometheus())
+            os.replace(temp_path, path)
+        except BaseException:
+            os.remove(temp_path)
+            raise
+
+    def serve(self, port: int, host: str = '') -> ThreadingHTTPServer:
+        registry = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = registry.to_prometheus().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', CONTENT_TYPE)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = ThreadingHTTPServer((host, port), MetricsHandler)
+        threading.Thread(target=server.serve_forever, name='metrics-http', daemon=True).start()
+        return server
+
+
+class SampledLogger:
+    """Logs at most burst messages per interval for each key and reports how many were dropped."""
+
+    def __init__(self, logger: logging.Logger, burst: int = DEFAULT_SAMPLE_BURST,
+                 interval: float = DEFAULT_SAMPLE_INTERVAL):
+        self.logger = logger
+        self.burst = burst
+        self.interval = interval
+        self.windows: Dict[str, List] = {}
+        self.lock = threading.Lock()
+
+    def log(self, level: int, key: str, message: str) -> None:
+        if not self.logger.isEnabledFor(level):
+            return
+        now = time.monotonic()
+        with self.lock:
+            window = self.windows.get(key)
+            if window is None or now - window[0] >= self.interval:
+                suppressed = window[2] if window is not None else 0
+                window = self.windows[key] = [now, 0, 0]
+            else:
+                suppressed = 0
+            if window[1] >= self.burst:
+                window[2] += 1
+                return
+            window[1] += 1
+        if suppressed:
+            message = f"{message} ({suppressed} similar messages suppressed)"
+        self.logger.log(level, message)
+
+    def info(self, key: str, message: str) -> None:
+        self.log(logging.INFO, key, message)
+
+    def warning(self, key: str, message: str) -> None:
+        self.log(logging.WARNING, key, message)
+
+
+def format_value(value: Union[int, float]) -> str:
+    if isinstance(value, int):
+        return str(value)
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+REGISTRY = MetricsRegistry()
+
+
+def counter(name: str, help_text: str = '') -> Counter:
+    return REGISTRY.counter(name, help_text)
+
+
+def histogram(name: str, help_text: str = '', buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+    return REGISTRY.histogram(name, help_text, buckets)
+
+
+def export(path: Optional[str]) -> None:
+    if path:
+        try:
+            REGISTRY.write_prometheus(path)
+        except Exception as e:
+            logging.error(f"An error occurred while writing metrics to {path}: {e}")
@@ -0,0 +1,59 @@
+import os
+import tempfile
+import unittest
+
+from benchmarks.Benchmarks import generate_lines, generate_name_files, generate_file_tree, percentile, \
+    summarize_runs, bench_move_files, bench_file_merger
+from tasks.FileMerger import BACKEND_DISK, BACKEND_MEMORY
+
+
+class TestBenchmarks(unittest.TestCase):
+
+    def test_generate_lines(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            path = os.path.join(tempdir, 'lines.txt')
+            generate_lines(path, 10, min_length=2, max_length=3)
+            with open(path) as f:
+                lines = f.read().splitlines()
+            self.assertEqual(10, len(lines))
+            self.assertTrue(all(2 <= len(line) <= 3 for line in lines))
+
+    def test_generate_name_files(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            names_path, surnames_path = generate_name_files(tempdir, 5)
+            for path in (names_path, surnames_path):
+                with open(path) as f:
+                    ids = sorted(int(line.split()[1]) for line in f)
+                self.assertEqual([1, 2, 3, 4, 5], ids)
+
+    def test_generate_file_tree(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            paths = generate_file_tree(tempdir, 3, 16)
+            self.assertEqual(3, len(paths))
+            self.assertTrue(all(os.path.getsize(path) == 16 for path in paths))
+
+    def test_percentile(self):
+        samples = [float(i) for i in range(1, 101)]
+        self.assertEqual(50.0, percentile(samples, 0.50))
+        self.assertEqual(99.0, percentile(samples, 0.99))
+        self.assertEqual(7.0, percentile([7.0], 0.99))
+
+    def test_summarize_runs(self):
+        result = summarize_runs('name', {}, 60, 'lines/s', [3.0, 1.0, 2.0])
+        self.assertEqual(10.0, result['throughput'])
+        self.assertEqual((1.0, 2.0, 3.0), (result['min_run_seconds'], result['median_run_seconds'],
+                                           result['max_run_seconds']))
+        self.assertNotIn('p99_seconds', result)
+
+    def test_bench_move_files(self):
+        result = bench_move_files(files=5, size=8, workers=2)
+        self.assertEqual('file_mover.move_files', result['name'])
+        self.assertGreater(result['throughput'], 0)
+        self.assertLessEqual(result['p50_seconds'], result['p99_seconds'])
+
+    def test_bench_file_merger_local_backends(self):
+        for backend in (BACKEND_MEMORY, BACKEND_DISK):
+            result = bench_file_merger(ids=20, repeat=1, chunk_size=7, backend=backend)
+            self.assertEqual(backend, result['params']['backend'])
+            self.assertGreater(result['throughput'], 0)
+            self.assertLessEqual(result['min_run_seconds'], result['max_run_seconds'])
@@ -0,0 +1,91 @@
+import bz2
+import gzip
+import lzma
+import os
+import tempfile
+import unittest
+
+from tasks.CompressedIO import detect_compression, open_file, skip, COMPRESSION_GZIP, COMPRESSION_BZ2, COMPRESSION_XZ
+
+
+class TestCompressedIO(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def path(self, name):
+        return os.path.join(self.tempdir.name, name)
+
+    def test_detect_compression_by_extension(self):
+        self.assertEqual(COMPRESSION_GZIP, detect_compression(self.path('names.txt.gz')))
+        self.assertEqual(COMPRESSION_BZ2, detect_compression(self.path('names.txt.BZ2')))
+        self.assertEqual(COMPRESSION_XZ, detect_compression(self.path('names.xz')))
+        self.assertIsNone(detect_compression(self.path('missing.txt')))
+
+    def test_detect_compression_by_magic_number(self):
+        for module, compression in ((gzip, COMPRESSION_GZIP), (bz2, COMPRESSION_BZ2), (lzma, COMPRESSION_XZ)):
+            path = self.path(f'{compression}.dat')
+            with module.open(path, 'wb') as f:
+                f.write(b'Adam 1\n')
+            self.assertEqual(compression, detect_compression(path))
+        plain = self.path('plain.txt')
+        with open(plain, 'wb') as f:
+            f.write(b'Adam 1\n')
+        self.assertIsNone(detect_compression(plain))
+        empty = self.path('empty.dat')
+        with bz2.open(empty, 'wb'):
+            pass
+        self.assertEqual(COMPRESSION_BZ2, detect_compression(empty))
+
+    def test_plain_file_starting_with_bzh(self):
+        path = self.path('names.txt')
+        with open(path, 'w') as f:
+            f.write('BZhang 1\nBZh91AY 2\n')
+        self.assertIsNone(detect_compression(path))
+        with open_file(path, 'r') as f:
+            self.assertEqual(['BZhang 1\n', 'BZh91AY 2\n'], f.readlines())
+
+    def test_round_trip(self):
+        lines = [f'Name{i} {i}\n' for i in range(10000)]
+        for name in ('lines.txt', 'lines.txt.gz', 'lines.txt.bz2', 'lines.txt.xz'):
+            path = self.path(name)
+            with open_file(path, 'w') as f:
+                f.writelines(lines)
+            with open_file(path, 'r') as f:
+                self.assertEqual(lines, f.readlines())
+            with open_file(path, 'rb') as f:
+                self.assertEqual(''.join(lines).encode(), f.read())
+        with open(self.path('lines.txt.gz'), 'rb') as f:
+            self.assertEqual(b'\x1f\x8b', f.read(2))
+
+    def test_skip(self):
+        for name in ('lines.txt', 'lines.txt.gz'):
+            path = self.path(name)
+            with open_file(path, 'wb') as f:
+                f.write(b'0123456789' * 1000)
+            with open_file(path, 'rb') as f:
+                skip(f, 9995)
+                self.assertEqual(b'56789', f.read())
+
+    def test_close_before_end(self):
+        path = self.path('large.gz')
+        with gzip.open(path, 'wb') as f:
+            f.write(os.urandom(8 * 1024 * 1024))
+        with open_file(path, 'rb') as f:
+            f.read(10)
+        self.assertTrue(f.closed)
+
+    def test_corrupt_input_raises(self):
+        path = self.path('corrupt.gz')
+        with open(path, 'wb') as f:
+            f.write(b'\x1f\x8b' + b'\x00' * 64)
+        with self.assertRaises(Exception):
+            with open_file(path, 'rb') as f:
+                f.read()
+
+
+if __name__ == '__main__':
+    unittest.main()
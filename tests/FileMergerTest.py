@@ -1,13 +1,18 @@
 import asyncio
 import csv
+import gzip
+import os
 import tempfile
 import unittest
+from unittest.mock import MagicMock, patch
 
 import aiofiles
+import fakeredis
 import redis
 from testcontainers.redis import RedisContainer
 
-from tasks.FileMerger import FileMerger
+from tasks.FileMerger import FileMerger, AsyncFileMerger, MemoryFileMerger, DiskFileMerger, CompactFileMerger, \
+    ShardedFileMerger, HashRing, IngestError, parse_node, id_score, copy_range, main, CHECKPOINTS_KEY
 
 
 class TestFileMerger(unittest.TestCase):
@@ -43,6 +48,51 @@ class TestFileMerger(unittest.TestCase):
 
         asyncio.run(run_test())
 
+    def test_process_resume(self):
+        async def run_test():
+            with tempfile.NamedTemporaryFile() as temp_input:
+                temp_input.write(b'Adam 1234\nJohn 4321\nJosh 5541\n')
+                temp_input.flush()
+                checkpoint_field = FileMerger.checkpoint_field(temp_input.name, 'First')
+
+                await self.file_merger.process(temp_input.name, 'First', chunk_size=2)
+                self.assertEqual(30, self.file_merger.load_checkpoint(checkpoint_field))
+
+                self.file_merger.redis.hset('checkpoints', checkpoint_field, 10)
+                self.file_merger.redis.delete('1234', '4321', '5541')
+                processed = await self.file_merger.process(temp_input.name, 'First', chunk_size=2, resume=True)
+                self.assertEqual(2, processed)
+
+            self.assertEqual({}, self.file_merger.redis.hgetall('1234'))
+            self.assertEqual(b'John', self.file_merger.redis.hget('4321', 'First'))
+            self.assertEqual(b'Josh', self.file_merger.redis.hget('5541', 'First'))
+
+        asyncio.run(run_test())
+
+    def test_process_skips_invalid_ids(self):
+        lines = [b'Name%d %d\n' % (i, i) for i in range(300)]
+        invalid = [b'Bad abc\n', b'Nan nan\n', b'Sep 1_0\n', b'Huge 1e400\n', b'Tiny 1e-400\n',
+                   'Arabic \u0661\u0662\n'.encode('utf-8')]
+        lines[150:150] = invalid
+        with tempfile.NamedTemporaryFile() as temp_input:
+            temp_input.write(b''.join(lines))
+            temp_input.flush()
+            for bulk, block_bytes in ((False, None), (True, None), (False, 64)):
+                self.redis_client.flushall()
+                file_merger = FileMerger(redis_host=self.redis_host, redis_port=self.redis_port, bulk=bulk,
+                                         block_bytes=block_bytes)
+                processed = asyncio.run(file_merger.process(temp_input.name, 'First', chunk_size=10))
+                self.assertEqual(300 + len(invalid), processed)
+                self.assertEqual(300, file_merger.redis.zcard('sorted_ids'))
+                self.assertEqual(b'Name299', file_merger.redis.hget('299', 'First'))
+
+    def test_id_score(self):
+        for id_, score in (('12', 12.0), (b'-1.5', -1.5), ('inf', float('inf')), ('-Infinity', float('-inf')),
+                           ('1e-310', 1e-310), ('0e5', 0.0), ('-0.000', 0.0)):
+            self.assertEqual(score, id_score(id_), id_)
+        for id_ in ('abc', 'nan', '1_0', '1e400', '-1e400', '1e-400', '0.1e-400', '\u0661\u0662', b'\xd9\xa1', ''):
+            self.assertIsNone(id_score(id_), id_)
+
     def test_read_chunk(self):
         async def run_test():
             with tempfile.NamedTemporaryFile() as temp_input:
@@ -67,11 +117,49 @@ class TestFileMerger(unittest.TestCase):
         self.assertEqual(self.file_merger.redis.hget('1234', 'First'), b'Adam')
         self.assertEqual(self.file_merger.redis.hget('4321', 'First'), b'John')
 
+    def test_process_data_bulk(self):
+        lines = ['Adam 1234', 'John 4321', 'invalid']
+        file_merger = FileMerger(redis_host=self.redis_host, redis_port=self.redis_port, bulk=True, pipeline_bytes=1)
+        file_merger.process_data_bulk(lines, 'First')
+        self.assertEqual(file_merger.redis.hget('1234', 'First'), b'Adam')
+        self.assertEqual(file_merger.redis.hget('4321', 'First'), b'John')
+        self.assertEqual(file_merger.redis.zrange('sorted_ids', 0, -1), [b'1234', b'4321'])
+
     def test_get_ids(self):
         self.file_merger.redis.zadd('sorted_ids', {'1': 1, '10': 10, '2': 2})
         ids = self.file_merger.get_ids(0, 2)
         self.assertEqual(ids, ['1', '2'])
 
+    def test_fetch_rows(self):
+        self.file_merger.redis.zadd('sorted_ids', {'1': 1, '01': 1, '2': 2, '10': 10})
+        self.file_merger.redis.hset('1', mapping={'First': 'Adam', 'Last': 'Johnson'})
+        self.file_merger.redis.hset('10', mapping={'First': 'John'})
+        rows, cursor = self.file_merger.fetch_rows(float('-inf'), 0, 1)
+        self.assertEqual([['No data found', 'No data found', '01']], rows)
+        rows, cursor = self.file_merger.fetch_rows(*cursor, 2)
+        self.assertEqual([['Adam', 'Johnson', '1'], ['No data found', 'No data found', '2']], rows)
+        rows, cursor = self.file_merger.fetch_rows(*cursor, 2)
+        self.assertEqual([['John', '', '10']], rows)
+        self.assertEqual(([], None), self.file_merger.fetch_rows(*cursor, 2))
+
+    def test_iter_rows(self):
+        self.file_merger.redis.zadd('sorted_ids', {str(i): i for i in range(5)})
+        pages = list(self.file_merger.iter_rows(2))
+        self.assertEqual([2, 2, 1], [len(rows) for rows in pages])
+        self.assertEqual(['0', '1', '2', '3', '4'], [row[2] for rows in pages for row in rows])
+
+    def test_compact_layout(self):
+        file_merger = CompactFileMerger(redis_host=self.redis_host, redis_port=self.redis_port, bucket_size=2)
+        file_merger.process_data(['Adam 3', 'John 1', 'Eve 10', 'Bad x'], 'First')
+        file_merger.process_data(['Johnson 3', 'Doe 2'], 'Last')
+        self.assertEqual(b'Adam\tJohnson', file_merger.redis.hget('ids:1', '3'))
+        self.assertEqual([{'ID': '3', 'First': 'Adam', 'Last': 'Johnson'},
+                          {'ID': '4', 'First': 'No data found', 'Last': 'No data found'}],
+                         file_merger.get_data_by_ids(['3', '4']))
+        self.assertEqual(['2', '3'], file_merger.get_ids(1, 2))
+        rows = [row for rows in file_merger.iter_rows(2) for row in rows]
+        self.assertEqual([['John', '', '1'], ['', 'Doe', '2'], ['Adam', 'Johnson', '3'], ['Eve', '', '10']], rows)
+
     def test_get_data_by_ids(self):
         self.file_merger.redis.hset('1234', mapping={'First': 'Adam', 'Last': 'Johnson'})
         self.file_merger.redis.hset('4321', mapping={'First': 'John', 'Last': 'Adamson'})
@@ -95,3 +183,394 @@ class TestFileMerger(unittest.TestCase):
             rows = temp_output.readlines()
             self.assertEqual(1, len(rows))
             self.assertEqual( "John Adamson 1234", rows[0].strip())
+
+
+class TestAsyncFileMerger(unittest.TestCase):
+
+    def setUp(self):
+        server = fakeredis.FakeServer()
+        self.file_merger = AsyncFileMerger(max_in_flight=2, pipeline_bytes=64,
+                                           redis_client=fakeredis.FakeRedis(server=server),
+                                           async_redis_client=fakeredis.FakeAsyncRedis(server=server))
+
+    def test_process(self):
+        async def run_test():
+            with tempfile.NamedTemporaryFile() as temp_input:
+                temp_input.write(b''.join(b'Name%d %d\n' % (i, i) for i in range(50)))
+                temp_input.seek(0)
+
+                processed = await self.file_merger.process(temp_input.name, 'First', chunk_size=4)
+            await self.file_merger.close()
+            self.assertEqual(50, processed)
+
+        asyncio.run(run_test())
+        self.assertEqual(b'Name7', self.file_merger.redis.hget('7', 'First'))
+        self.assertEqual(50, self.file_merger.redis.zcard('sorted_ids'))
+
+    def test_failed_pipeline_fails_file(self):
+        flush_pipeline_async = AsyncFileMerger.flush_pipeline_async
+        calls = []
+
+        async def fail_third(pipeline, scores):
+            calls.append(scores)
+            if len(calls) == 3:
+                raise redis.ConnectionError('connection lost')
+            await flush_pipeline_async(pipeline, scores)
+
+        async def run_test():
+            with tempfile.NamedTemporaryFile() as temp_input:
+                temp_input.write(b''.join(b'Name%d %d\n' % (i, i) for i in range(50)))
+                temp_input.flush()
+                with patch.object(AsyncFileMerger, 'flush_pipeline_async', side_effect=fail_third):
+                    with self.assertRaises(IngestError):
+                        await self.file_merger.process(temp_input.name, 'First', chunk_size=4)
+            await self.file_merger.close()
+
+        asyncio.run(run_test())
+
+    def test_blocking_connection_pool(self):
+        file_merger = AsyncFileMerger(max_connections=2, max_in_flight=12)
+        self.assertIsInstance(file_merger.async_redis.connection_pool, redis.asyncio.BlockingConnectionPool)
+        with self.assertRaises(ValueError):
+            AsyncFileMerger(max_in_flight=0)
+
+    def test_main(self):
+        async def run_test():
+            with tempfile.NamedTemporaryFile() as names, tempfile.NamedTemporaryFile() as surnames, \
+                    tempfile.NamedTemporaryFile(mode='w+') as result:
+                names.write(b'Adam 2\nJohn 1\n')
+                names.flush()
+                surnames.write(b'Smith 1\nJohnson 2\n')
+                surnames.flush()
+
+                await self.file_merger.main(names.name, surnames.name, result.name)
+                await self.file_merger.close()
+                return result.readlines()
+
+        self.assertEqual(['John Smith 1\n', 'Adam Johnson 2\n'], asyncio.run(run_test()))
+
+
+class TestShardedFileMerger(unittest.TestCase):
+
+    def setUp(self):
+        self.shard_clients = [fakeredis.FakeRedis(server=fakeredis.FakeServer()) for _ in range(3)]
+        self.file_merger = ShardedFileMerger(pipeline_bytes=64, redis_clients=self.shard_clients)
+
+    def test_main(self):
+        with tempfile.NamedTemporaryFile() as names, tempfile.NamedTemporaryFile() as surnames, \
+                tempfile.NamedTemporaryFile(mode='w+') as result:
+            names.write(b''.join(b'Name%d %d\n' % (i, i) for i in range(100, 0, -1)) + b'Adele 10.0\n')
+            names.flush()
+            surnames.write(b''.join(b'Surname%d %d\n' % (i, i) for i in range(1, 101)))
+            surnames.flush()
+
+            asyncio.run(self.file_merger.main(names.name, surnames.name, result.name, chunk_size=7,
+                                              writer_chunk_size=6))
+            rows = result.read().splitlines()
+
+        expected = [f'Name{i} Surname{i} {i}' for i in range(1, 101)]
+        expected.insert(10, 'Adele  10.0')
+        self.assertEqual(expected, rows)
+        sizes = [client.zcard('sorted_ids') for client in self.shard_clients]
+        self.assertEqual(101, sum(sizes))
+        self.assertTrue(all(sizes))
+
+    def test_get_ids_and_data(self):
+        self.file_merger.process_data([f'Name{i} {i}' for i in range(20)], 'First')
+        self.assertEqual(['5', '6', '7'], self.file_merger.get_ids(5, 3))
+        self.assertEqual([{'ID': '7', 'First': 'Name7', 'Last': ''},
+                          {'ID': '99', 'First': 'No data found', 'Last': 'No data found'},
+                          {'ID': '3', 'First': 'Name3', 'Last': ''}],
+                         self.file_merger.get_data_by_ids(['7', '99', '3']))
+
+    def test_checkpoint_on_first_shard(self):
+        self.assertTrue(self.file_merger.process_data(['Adam 1', 'Eve x'], 'First', ('First:names', 10)))
+        self.assertEqual(10, self.file_merger.load_checkpoint('First:names'))
+        self.assertEqual(1, sum(client.zcard('sorted_ids') for client in self.shard_clients))
+
+    def test_hash_ring_stability(self):
+        ids = [str(i) for i in range(2000)]
+        ring = HashRing(['a:6379', 'b:6379', 'c:6379'])
+        grown = HashRing(['a:6379', 'b:6379', 'c:6379', 'd:6379'])
+        moved = [id_ for id_ in ids if ring.shard(id_) != grown.shard(id_)]
+        self.assertTrue(all(grown.shard(id_) == 3 for id_ in moved))
+        self.assertLess(len(moved), len(ids) * 0.4)
+
+    def test_parse_node(self):
+        self.assertEqual(('redis-1', 6380, 2), parse_node('redis-1:6380/2'))
+        self.assertEqual(('redis-1', 6379, 0), parse_node('redis-1'))
+
+
+class TestBlockReader(unittest.TestCase):
+
+    def setUp(self):
+        self.file_merger = FileMerger(redis_client=fakeredis.FakeRedis(server=fakeredis.FakeServer()), block_bytes=16)
+
+    def test_parse_block(self):
+        self.assertEqual(([(b'1', b'Adam'), (b'2', b'Eve')], 2), FileMerger.parse_block(b'Adam 1\r\n  Eve\t2 \n'))
+        self.assertEqual(([(b'1', b'Adam'), (b'3', b'Eve')], 4), FileMerger.parse_block(b'Adam 1\n\nbad line here\nEve 3'))
+
+    def test_parse_block_non_ascii(self):
+        # Whitespace is whatever str.split() splits on, exactly as for the line reader
+        block = 'José 1\nJosé\xa0Maria 2\nAnna\x1c3\n'.encode()
+        lines = [line.decode().strip() for line in block.splitlines()]
+        self.assertEqual((FileMerger.validate_lines(lines), 3), FileMerger.parse_block(block))
+        self.assertEqual(([('1', 'José'), ('3', 'Anna')], 3), FileMerger.parse_block(block))
+
+    def test_iter_blocks(self):
+        with tempfile.NamedTemporaryFile() as temp_input:
+            temp_input.write(b''.join(b'Name%d %d\n' % (i, i) for i in range(20)) + b'Last 20')
+            temp_input.flush()
+            size = os.path.getsize(temp_input.name)
+
+            blocks = list(FileMerger.iter_blocks(temp_input.name, 16))
+            self.assertEqual(list(range(21)), [int(id_) for records, _, _ in blocks for id_, _ in records])
+            self.assertEqual(21, sum(lines for _, lines, _ in blocks))
+            self.assertEqual(size, blocks[-1][2])
+
+            self.assertEqual(16, blocks[0][2])
+            resumed = list(FileMerger.iter_blocks(temp_input.name, 1024, blocks[0][2]))
+            self.assertEqual((b'2', b'Name2'), resumed[0][0][0])
+            self.assertEqual(19, resumed[0][1])
+            self.assertEqual([], list(FileMerger.iter_blocks(temp_input.name, 16, size)))
+
+    def test_process_blocks(self):
+        with tempfile.NamedTemporaryFile() as temp_input:
+            temp_input.write(b''.join(b'Name%d %d\n' % (i, i) for i in range(30)))
+            temp_input.flush()
+
+            processed = asyncio.run(self.file_merger.process(temp_input.name, 'First'))
+            checkpoint = self.file_merger.load_checkpoint(self.file_merger.checkpoint_field(temp_input.name, 'First'))
+            self.assertEqual(os.path.getsize(temp_input.name), checkpoint)
+        self.assertEqual(30, processed)
+        self.assertEqual(b'Name7', self.file_merger.redis.hget('7', 'First'))
+        self.assertEqual(30, self.file_merger.redis.zcard('sorted_ids'))
+
+    def test_process_compressed(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            path = os.path.join(tempdir, 'names.txt.gz')
+            with gzip.open(path, 'wb') as f:
+                f.write(b''.join(b'Name%d %d\n' % (i, i) for i in range(30)))
+            field = self.file_merger.checkpoint_field(path, 'First')
+
+            self.assertEqual(30, asyncio.run(self.file_merger.process(path, 'First')))
+            self.assertEqual(len(gzip.open(path).read()), self.file_merger.load_checkpoint(field))
+
+            self.file_merger.block_bytes = None
+            self.file_merger.redis.flushall()
+            self.file_merger.redis.hset(CHECKPOINTS_KEY, field, 16)
+            self.assertEqual(28, asyncio.run(self.file_merger.process(path, 'First', chunk_size=4, resume=True)))
+        self.assertIsNone(self.file_merger.redis.hget('1', 'First'))
+        self.assertEqual(b'Name29', self.file_merger.redis.hget('29', 'First'))
+        self.assertEqual(28, self.file_merger.redis.zcard('sorted_ids'))
+
+    def test_sharded_process_blocks(self):
+        clients = [fakeredis.FakeRedis(server=fakeredis.FakeServer()) for _ in range(2)]
+        file_merger = ShardedFileMerger(redis_clients=clients, block_bytes=32)
+        with tempfile.NamedTemporaryFile() as temp_input:
+            temp_input.write(b''.join(b'Name%d %d\n' % (i, i) for i in range(30)))
+            temp_input.flush()
+            asyncio.run(file_merger.process(temp_input.name, 'First'))
+        self.assertEqual(30, sum(client.zcard('sorted_ids') for client in clients))
+        self.assertEqual([{'ID': '7', 'First': 'Name7', 'Last': ''}], file_merger.get_data_by_ids(['7']))
+
+    def test_benchmark_readers(self):
+        with tempfile.NamedTemporaryFile() as temp_input:
+            temp_input.write(b'Adam 1\nEve 2\n')
+            temp_input.flush()
+            rates = FileMerger.benchmark_readers(temp_input.name)
+        self.assertEqual({'lines', 'blocks'}, set(rates))
+        self.assertTrue(all(rate > 0 for rate in rates.values()))
+
+
+class TestIncrementalFileMerger(unittest.TestCase):
+
+    def setUp(self):
+        self.file_merger = FileMerger(redis_client=fakeredis.FakeRedis(server=fakeredis.FakeServer()))
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.names = os.path.join(self.tempdir.name, 'names.txt')
+        self.surnames = os.path.join(self.tempdir.name, 'surnames.txt')
+        self.result = os.path.join(self.tempdir.name, 'result.txt')
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    @staticmethod
+    def write(path, lines):
+        with open(path, 'w') as f:
+            f.writelines(line + '\n' for line in lines)
+
+    def run_incremental(self, names, surnames):
+        self.write(self.names, names)
+        self.write(self.surnames, surnames)
+        asyncio.run(self.file_merger.main_incremental(self.names, self.surnames, self.result))
+        with open(self.result) as f:
+            return f.read().splitlines()
+
+    def test_main_incremental(self):
+        names = [f'Name{i} {i}' for i in range(1, 201)]
+        surnames = [f'Surname{i} {i}' for i in range(1, 201)]
+        rows = self.run_incremental(names, surnames)
+        self.assertEqual([f'Name{i} Surname{i} {i}' for i in range(1, 201)], rows)
+
+        names[49] = 'Changed 50'
+        del names[99]
+        del surnames[99]
+        del surnames[149]
+        names.append('Added 1000')
+        with patch.object(self.file_merger, 'print_result_file') as print_result_file:
+            rows = self.run_incremental(names, surnames)
+        print_result_file.assert_not_called()
+
+        expected = {i: f'Name{i} Surname{i} {i}' for i in range(1, 201)}
+        expected[50] = 'Changed Surname50 50'
+        del expected[100]
+        expected[151] = 'Name151  151'
+        expected[1000] = 'Added  1000'
+        self.assertEqual([expected[i] for i in sorted(expected)], rows)
+        self.assertIsNone(self.file_merger.redis.zscore('sorted_ids', '100'))
+        self.assertFalse(self.file_merger.redis.exists('100'))
+
+    def test_only_changed_chunks_are_ingested(self):
+        names = [f'Name{i} {i}' for i in range(1, 1001)]
+        self.run_incremental(names, [])
+        names[500] = 'Changed 501'
+        with patch.object(self.file_merger, 'process_data', wraps=self.file_merger.process_data) as process_data:
+            self.run_incremental(names, [])
+        ingested = [line for call in process_data.call_args_list for line in call.args[0]]
+        self.assertIn('Changed 501', ingested)
+        self.assertLess(len(ingested), 200)
+
+    def test_interrupted_run_converges(self):
+        names = [f'Name{i} {i}' for i in range(1, 101)]
+        self.run_incremental(names, [])
+        names[20] = 'Changed 21'
+        del names[10]
+        with patch.object(self.file_merger, 'delete_fields', side_effect=RuntimeError('interrupted')):
+            with self.assertRaises(RuntimeError):
+                self.run_incremental(names, [])
+        rows = self.run_incremental(names, [])
+        self.assertNotIn('Name11  11', rows)
+        self.assertIn('Changed  21', rows)
+        self.assertEqual(99, len(rows))
+
+    def test_fingerprint_chunks(self):
+        lines = [f'Name{i} {i}' for i in range(1000)]
+        self.write(self.names, lines)
+        before = self.file_merger.fingerprint_chunks(self.names)
+        self.write(self.names, lines[:500] + ['Inserted 5000'] + lines[500:])
+        after = self.file_merger.fingerprint_chunks(self.names)
+        self.assertEqual(os.path.getsize(self.names), after[-1][2])
+        changed = {fingerprint for fingerprint, _, _ in after} - {fingerprint for fingerprint, _, _ in before}
+        self.assertEqual(1, len(changed))
+
+    def test_print_result_file_overwrites(self):
+        self.file_merger.process_data(['Adam 1'], 'First')
+        self.file_merger.print_result_file(self.result)
+        self.file_merger.print_result_file(self.result)
+        with open(self.result) as f:
+            self.assertEqual(['Adam  1'], f.read().splitlines())
+
+    def test_copy_range_writes_bounded_chunks(self):
+        destination = MagicMock()
+        with patch('tasks.FileMerger.EXPORT_BUFFER_BYTES', 4):
+            copy_range(b'0123456789', 1, 10, destination)
+        chunks = [bytes(call.args[0]) for call in destination.write.call_args_list]
+        self.assertEqual([b'1234', b'5678', b'9'], chunks)
+
+
+class TestLocalFileMergers(unittest.TestCase):
+
+    def run_main(self, file_merger, resume=False):
+        with tempfile.NamedTemporaryFile() as names, tempfile.NamedTemporaryFile() as surnames, \
+                tempfile.NamedTemporaryFile(mode='w+') as result:
+            names.write(b'Adam 10\nJohn 2\nEve 1\nAdele 10\n')
+            names.flush()
+            surnames.write(b'Smith 2\nJohnson 10\nDoe 3\n')
+            surnames.flush()
+
+            asyncio.run(file_merger.main(names.name, surnames.name, result.name, chunk_size=1, writer_chunk_size=2,
+                                         resume=resume))
+            return result.read().splitlines()
+
+    def test_memory_main(self):
+        rows = self.run_main(MemoryFileMerger())
+        self.assertEqual(['Eve  1', 'John Smith 2', ' Doe 3', 'Adele Johnson 10'], rows)
+
+    def test_disk_main(self):
+        file_merger = DiskFileMerger(memory_limit=1)
+        rows = self.run_main(file_merger)
+        self.assertEqual(['Eve  1', 'John Smith 2', ' Doe 3', 'Adele Johnson 10'], rows)
+        self.assertEqual({'First': [], 'Last': []}, file_merger.runs)
+
+    def test_failed_chunk_fails_main(self):
+        file_merger = MemoryFileMerger()
+        process_data = file_merger.process_data
+
+        def fail_surnames(lines, key, checkpoint=None):
+            return key != 'Last' and process_data(lines, key, checkpoint)
+
+        with tempfile.TemporaryDirectory() as tempdir, \
+                patch.object(file_merger, 'process_data', side_effect=fail_surnames):
+            paths = [os.path.join(tempdir, name) for name in ('names.txt', 'surnames.txt', 'result.txt')]
+            for path, content in zip(paths, ('Adam 1\n', 'Smith 1\n')):
+                with open(path, 'w') as f:
+                    f.write(content)
+            with self.assertRaises(IngestError):
+                asyncio.run(file_merger.main(*paths))
+            self.assertFalse(os.path.exists(paths[2]))
+        self.assertEqual(['1'], file_merger.get_ids(0, 10))
+
+    def test_cli_exits_non_zero_when_ingest_fails(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            result = os.path.join(tempdir, 'result.txt')
+            argv = ['FileMerger', os.path.join(tempdir, 'missing.txt'), os.path.join(tempdir, 'missing.txt'), result,
+                    '--backend', 'memory']
+            with patch('sys.argv', argv), self.assertRaises(SystemExit) as exit_info:
+                main()
+            self.assertEqual(1, exit_info.exception.code)
+            self.assertFalse(os.path.exists(result))
+
+    def test_resume_and_memory_usage(self):
+        for file_merger in (MemoryFileMerger(), DiskFileMerger(memory_limit=1)):
+            with self.assertLogs('tasks.FileMerger', 'WARNING'):
+                rows = self.run_main(file_merger, resume=True)
+            self.assertEqual(['Eve  1', 'John Smith 2', ' Doe 3', 'Adele Johnson 10'], rows)
+            with self.assertRaises(NotImplementedError):
+                asyncio.run(file_merger.main_incremental('first.txt', 'last.txt', 'result.txt'))
+        memory_merger = MemoryFileMerger()
+        memory_merger.process_data(['Adam 1234'], 'First')
+        self.assertGreater(memory_merger.memory_usage(), 0)
+        disk_merger = DiskFileMerger()
+        disk_merger.process_data(['Adam 1234'], 'First')
+        self.assertGreater(disk_merger.memory_usage(), 0)
+
+    def test_invalid_ids_are_sampled(self):
+        file_merger = MemoryFileMerger()
+        with patch('tasks.FileMerger.sampled_logger.warning') as warning:
+            file_merger.process_data([f'Name{i} x{i}' for i in range(50)] + ['Adam 1'], 'First')
+        self.assertEqual({'invalid_id'}, {call.args[0] for call in warning.call_args_list})
+        self.assertEqual(['1'], file_merger.get_ids(0, 10))
+
+    def test_disk_get_ids_and_data(self):
+        file_merger = DiskFileMerger(memory_limit=1)
+        file_merger.process_data(['Adam 10', 'Eve 2'], 'First')
+        file_merger.process_data(['Johnson 10', 'Doe 3'], 'Last')
+        self.assertEqual(['2', '3'], file_merger.get_ids(0, 2))
+        self.assertEqual(['10'], file_merger.get_ids(2, 2))
+        self.assertEqual([{'ID': '10', 'First': 'Adam', 'Last': 'Johnson'},
+                          {'ID': '1', 'First': 'No data found', 'Last': 'No data found'},
+                          {'ID': '3', 'First': '', 'Last': 'Doe'}],
+                         file_merger.get_data_by_ids(['10', '1', '3']))
+        self.assertEqual(3, sum(len(rows) for rows in file_merger.iter_rows()))
+        with self.assertRaises(RuntimeError):
+            file_merger.get_ids()
+
+    def test_memory_get_data_by_ids(self):
+        file_merger = MemoryFileMerger()
+        file_merger.process_data(['Adam 1234'], 'First')
+        file_merger.process_data(['Johnson 1234'], 'Last')
+        self.assertEqual(['1234'], file_merger.get_ids(0, 2))
+        self.assertEqual([{'ID': '1234', 'First': 'Adam', 'Last': 'Johnson'},
+                          {'ID': '1', 'First': 'No data found', 'Last': 'No data found'}],
+                         file_merger.get_data_by_ids(['1234', '1']))
@@ -1,8 +1,12 @@
+import glob
+import gzip
+import lzma
+import os
 import tempfile
 import unittest
 from collections import Counter
 
-from tasks.LinesSorter import LinesSorter
+from tasks.LinesSorter import LinesSorter, KeyIndex, BACKEND_NUMPY, GROUP_LINES, INDEX_SUFFIX, np
 
 
 class TestLinesSorter(unittest.TestCase):
@@ -20,6 +24,20 @@ class TestLinesSorter(unittest.TestCase):
         sorted_characters = LinesSorter.sort_characters(counter)
         self.assertEqual(['a', 'a', 'b', 'b', 'c', 'c'], sorted_characters)
 
+    @unittest.skipIf(np is None, "numpy is not installed")
+    def test_sort_letters_batch(self):
+        words = ["dbca", "", "dddca", "zéa", "b a", "Ba"]
+        self.assertEqual([LinesSorter.sort_letters(word) for word in words], LinesSorter.sort_letters_batch(words))
+
+    @unittest.skipIf(np is None, "numpy is not installed")
+    def test_sort_lines_numpy_backend(self):
+        with tempfile.NamedTemporaryFile(mode='w+') as temp_file:
+            temp_file.write("this\nis\nan\nexample")
+            temp_file.seek(0)
+
+            sorted_lines = LinesSorter.sort_lines(temp_file.name, backend=BACKEND_NUMPY)
+            self.assertEqual(sorted_lines, ["aeelmpx", "an", "hist", "is"])
+
     def test_sort_lines(self):
         with tempfile.NamedTemporaryFile(mode='w+') as temp_file:
             temp_file.write("this\nis\nan\nexample")
@@ -28,9 +46,143 @@ class TestLinesSorter(unittest.TestCase):
             sorted_lines = LinesSorter.sort_lines(temp_file.name)
             self.assertEqual(sorted_lines, ["aeelmpx", "an", "hist", "is"])
 
+    def test_sort_lines_external(self):
+        with tempfile.NamedTemporaryFile(mode='w+') as temp_file:
+            temp_file.write("this\nis\nan\nexample\nthis\n a b\n\nzz")
+            temp_file.seek(0)
+
+            expected = LinesSorter.sort_lines(temp_file.name)
+            sorted_lines = list(LinesSorter.sort_lines(temp_file.name, memory_limit=100))
+            self.assertEqual(expected, sorted_lines)
+
+    def test_runs_deleted_when_writing_fails(self):
+        pattern = os.path.join(tempfile.gettempdir(), 'linessorter-*.run')
+        existing = set(glob.glob(pattern))
+        with tempfile.NamedTemporaryFile(mode='w+') as temp_file:
+            temp_file.write("".join(f"line{i}\n" for i in range(1000)))
+            temp_file.flush()
+            for workers in (1, 2):
+                sorted_lines = LinesSorter.sort_lines(temp_file.name, memory_limit=10000, workers=workers)
+                self.assertNotEqual(existing, set(glob.glob(pattern)))
+                LinesSorter.write_to_file(sorted_lines, os.path.join(temp_file.name, 'missing', 'out.txt'))
+                self.assertEqual(existing, set(glob.glob(pattern)))
+                del sorted_lines
+
+            sorted_lines = LinesSorter.sort_lines(temp_file.name, memory_limit=10000)
+            del sorted_lines
+            self.assertEqual(existing, set(glob.glob(pattern)))
+
+    def test_spill_runs(self):
+        run_paths = LinesSorter.spill_runs(["dc", "ba", "a"], memory_limit=1)
+        try:
+            self.assertEqual(3, len(run_paths))
+            self.assertEqual(["a", "ba", "dc"], list(LinesSorter.merge_runs(run_paths)))
+            self.assertFalse(any(os.path.exists(path) for path in run_paths))
+        finally:
+            LinesSorter.delete_runs(run_paths)
+
+    def test_merge_runs_cascade(self):
+        keys = [str(i) for i in range(600)]
+        run_paths = LinesSorter.spill_runs(keys, memory_limit=1)
+        self.assertEqual(sorted(keys), list(LinesSorter.merge_runs(run_paths)))
+
+    def test_sort_lines_parallel(self):
+        with tempfile.NamedTemporaryFile(mode='w+') as temp_file:
+            temp_file.write("".join(f"line{i}\n" for i in range(100)) + "tail\r\nold\rmac")
+            temp_file.seek(0)
+
+            expected = LinesSorter.sort_lines(temp_file.name)
+            self.assertEqual(expected, LinesSorter.sort_lines(temp_file.name, workers=3))
+            self.assertEqual(expected, list(LinesSorter.sort_lines(temp_file.name, memory_limit=200, workers=3)))
+
+    def test_sort_lines_compressed(self):
+        content = "".join(f"line{i}\n" for i in range(100)) + "tail\r\nold\rmac"
+        with tempfile.TemporaryDirectory() as tempdir:
+            plain_path = os.path.join(tempdir, 'lines.txt')
+            with open(plain_path, 'w', newline='') as f:
+                f.write(content)
+            compressed_path = os.path.join(tempdir, 'lines.gz')
+            with gzip.open(compressed_path, 'wt', newline='') as f:
+                f.write(content)
+
+            expected = LinesSorter.sort_lines(plain_path)
+            self.assertEqual(expected, LinesSorter.sort_lines(compressed_path))
+            self.assertEqual(expected, LinesSorter.sort_lines(compressed_path, workers=3))
+            self.assertEqual(expected, list(LinesSorter.sort_lines(compressed_path, memory_limit=200)))
+
+            output_path = os.path.join(tempdir, 'sorted.txt.xz')
+            LinesSorter.write_to_file(expected, output_path)
+            with lzma.open(output_path, 'rt') as f:
+                self.assertEqual([line + '\n' for line in expected], f.readlines())
+
+    def test_chunk_boundaries(self):
+        with tempfile.NamedTemporaryFile(mode='wb') as temp_file:
+            temp_file.write(b"aaaa\nbb\ncccccc\nd")
+            temp_file.flush()
+
+            self.assertEqual([(0, 5), (5, 8), (8, 15), (15, 16)], LinesSorter.chunk_boundaries(temp_file.name, 4))
+            self.assertEqual([(0, 16)], LinesSorter.chunk_boundaries(temp_file.name, 1))
+
+    def test_read_range(self):
+        with tempfile.NamedTemporaryFile(mode='wb') as temp_file:
+            temp_file.write(b"ab\r\ncd\ref\ngh")
+            temp_file.flush()
+
+            self.assertEqual(["ab", "cd", "ef"], list(LinesSorter.read_range(temp_file.name, 0, 10, 'utf-8')))
+            self.assertEqual(["gh"], list(LinesSorter.read_range(temp_file.name, 10, 12, 'utf-8')))
+
+    def test_group_lines(self):
+        with tempfile.NamedTemporaryFile(mode='w+') as temp_file:
+            temp_file.write("listen\nsilent\nabc\nenlist\ncab")
+            temp_file.seek(0)
+
+            self.assertEqual({"eilnst": 3, "abc": 2}, LinesSorter.group_lines(temp_file.name))
+            self.assertEqual({"eilnst": ["listen", "silent", "enlist"], "abc": ["abc", "cab"]},
+                             LinesSorter.group_lines(temp_file.name, GROUP_LINES))
+
+    def test_write_groups(self):
+        with tempfile.NamedTemporaryFile(mode='w+') as temp_file:
+            LinesSorter.write_groups({"eilnst": ["listen", "silent"], "abc": ["cab"]}, temp_file.name)
+            content = temp_file.readlines()
+            self.assertEqual(content, ["abc\t1\tcab\n", "eilnst\t2\tlisten\tsilent\n"])
+
     def test_write_to_file(self):
         data = ["aeelmpx", "an", "hist", "is"]
         with tempfile.NamedTemporaryFile(mode='w+') as temp_file:
             LinesSorter.write_to_file(data, temp_file.name)
             content = temp_file.readlines()
             self.assertEqual(content, ["aeelmpx\n", "an\n", "hist\n", "is\n"])
+
+    def test_key_index(self):
+        keys = sorted(["a"] * 5 + ["a b"] + ["ab"] * 3 + ["abc", "b", "bb"] + ["c"] * 40 + ["d", "e\tf"])
+        with tempfile.TemporaryDirectory() as tempdir:
+            path = os.path.join(tempdir, 'sorted.txt')
+            for every in (1, 2, 7, 100):
+                LinesSorter.write_to_file(keys, path, index_every=every)
+                with open(path) as f:
+                    self.assertEqual([key + '\n' for key in keys], f.readlines())
+                with KeyIndex(path) as index:
+                    self.assertLessEqual(len(index.keys), len(keys) // every + 1)
+                    for key, count in Counter(keys).items():
+                        self.assertEqual(count, index.count(key), (every, key))
+                    for missing in ("", " ", "a ", "aa", "abd", "ba", "cc", "z"):
+                        self.assertNotIn(missing, index)
+
+    def test_key_index_empty_and_stale(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            path = os.path.join(tempdir, 'sorted.txt')
+            LinesSorter.write_to_file([], path, index_every=4)
+            with KeyIndex(path) as index:
+                self.assertEqual(0, index.count("a"))
+            LinesSorter.write_to_file(["a", "b"], path)
+            with self.assertRaises(ValueError):
+                KeyIndex(path)
+
+    def test_query_keys(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            path = os.path.join(tempdir, 'sorted.txt')
+            LinesSorter.write_to_file(["eilnst", "eilnst", "hist"], path, index_every=1)
+            self.assertTrue(os.path.exists(path + INDEX_SUFFIX))
+            self.assertEqual([("listen", "eilnst", 2), ("this", "hist", 1), ("abc", "abc", 0)],
+                             LinesSorter.query_keys(path, ["listen", "this", "abc"]))
+            self.assertIsNone(LinesSorter.query_keys(os.path.join(tempdir, 'missing.txt'), ["abc"]))
@@ -0,0 +1,111 @@
+import logging
+import os
+import tempfile
+import unittest
+import urllib.request
+from unittest.mock import patch
+
+from tasks.Metrics import MetricsRegistry, SampledLogger, Counter, Histogram
+
+
+class TestMetrics(unittest.TestCase):
+
+    def setUp(self):
+        self.registry = MetricsRegistry()
+
+    def test_counter(self):
+        requests = self.registry.counter('requests_total', 'Requests served')
+        requests.inc()
+        requests.inc(2)
+        self.assertIs(requests, self.registry.counter('requests_total'))
+        self.assertEqual(3, requests.value)
+        self.assertIsInstance(requests, Counter)
+
+    def test_metric_type_conflict(self):
+        self.registry.counter('work')
+        with self.assertRaises(ValueError):
+            self.registry.histogram('work')
+
+    def test_histogram_buckets(self):
+        latency = self.registry.histogram('latency_seconds', buckets=(0.1, 1.0))
+        for value in (0.05, 0.1, 0.5, 2.0):
+            latency.observe(value)
+        self.assertIsInstance(latency, Histogram)
+        self.assertEqual(4, latency.count)
+        self.assertEqual([
+            ('latency_seconds_bucket{le="0.1"}', 2),
+            ('latency_seconds_bucket{le="1.0"}', 3),
+            ('latency_seconds_bucket{le="+Inf"}', 4),
+            ('latency_seconds_sum', 2.65),
+            ('latency_seconds_count', 4),
+        ], latency.samples())
+
+    def test_histogram_timer(self):
+        latency = self.registry.histogram('latency_seconds')
+        with latency.time():
+            pass
+        with self.assertRaises(RuntimeError):
+            with latency.time():
+                raise RuntimeError()
+        self.assertEqual(2, latency.count)
+
+    def test_to_prometheus(self):
+        self.registry.counter('lines_total', 'Lines read').inc(5)
+        self.registry.histogram('read_seconds', buckets=(1.0,)).observe(0.5)
+        self.assertEqual(
+            '# HELP lines_total Lines read\n'
+            '# TYPE lines_total counter\n'
+            'lines_total 5\n'
+            '# TYPE read_seconds histogram\n'
+            'read_seconds_bucket{le="1.0"} 1\n'
+            'read_seconds_bucket{le="+Inf"} 1\n'
+            'read_seconds_sum 0.5\n'
+            'read_seconds_count 1\n',
+            self.registry.to_prometheus())
+
+    def test_write_prometheus(self):
+        self.registry.counter('lines_total').inc()
+        with tempfile.TemporaryDirectory() as tempdir:
+            path = os.path.join(tempdir, 'metrics.prom')
+            self.registry.write_prometheus(path)
+            with open(path) as f:
+                self.assertEqual(self.registry.to_prometheus(), f.read())
+            self.assertEqual(['metrics.prom'], os.listdir(tempdir))
+
+    def test_serve(self):
+        self.registry.counter('lines_total').inc(7)
+        server = self.registry.serve(0, '127.0.0.1')
+        try:
+            with urllib.request.urlopen(f"http://127.0.0.1:{server.server_address[1]}/metrics") as response:
+                self.assertIn('lines_total 7', response.read().decode('utf-8'))
+        finally:
+            server.shutdown()
+            server.server_close()
+
+
+class TestSampledLogger(unittest.TestCase):
+
+    def setUp(self):
+        self.logger = logging.getLogger('tests.sampled')
+        self.logger.setLevel(logging.INFO)
+
+    def test_burst_per_interval(self):
+        sampled_logger = SampledLogger(self.logger, burst=2, interval=60)
+        with self.assertLogs(self.logger, logging.WARNING) as logs:
+            for i in range(5):
+                sampled_logger.warning('invalid', f"bad line {i}")
+            sampled_logger.warning('other', "other key")
+        self.assertEqual(["bad line 0", "bad line 1", "other key"], [record.getMessage() for record in logs.records])
+
+    def test_reports_suppressed_messages(self):
+        sampled_logger = SampledLogger(self.logger, burst=1, interval=10)
+        with patch('tasks.Metrics.time.monotonic', side_effect=[0.0, 1.0, 2.0, 11.0]):
+            with self.assertLogs(self.logger, logging.INFO) as logs:
+                for i in range(4):
+                    sampled_logger.info('moved', f"moved {i}")
+        self.assertEqual(["moved 0", "moved 3 (2 similar messages suppressed)"],
+                         [record.getMessage() for record in logs.records])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,11 +1,18 @@
+import asyncio
+import errno
+import multiprocessing
 import os
 import tempfile
+import threading
+import time
 import unittest
 from multiprocessing import Lock
-from unittest.mock import MagicMock
+from unittest.mock import MagicMock, patch
 
 from tasks.FileMover import check_file_exists, check_file_does_not_exists, create_if_not_exists, get_lock_file_path, \
-    read_file, write_to_file, backup_file, restore_file, move, delete_files, move_file, release_locks
+    read_file, write_to_file, backup_file, restore_file, move, delete_files, move_file, release_locks, atomic_move, \
+    copy_to_temp_file, move_files, collect_sources, LockManager, MoveDaemon, move_files_async
+from filelock import Timeout
 
 
 class TestFileOperations(unittest.TestCase):
@@ -22,9 +29,51 @@ class TestFileOperations(unittest.TestCase):
 
             self.assertFalse(os.path.exists(src_file))
             self.assertTrue(os.path.exists(dest_file))
+            self.assertEqual(['dest'], os.listdir(tempdir))
             with open(dest_file, 'r') as f:
                 self.assertEqual(f.read(), 'Random text.')
 
+    def test_move_files(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            sources = [os.path.join(tempdir, f'source{i}.txt') for i in range(20)]
+            for source in sources:
+                write_to_file(source, b'Random text')
+            dest_dir = os.path.join(tempdir, 'dest')
+
+            results = move_files(sources + [os.path.join(tempdir, 'missing.txt')], dest_dir, workers=4)
+
+            self.assertEqual(21, len(results))
+            self.assertTrue(all(result.error is None for result in results[:20]))
+            self.assertIsNotNone(results[20].error)
+            self.assertEqual(sorted(f'source{i}.txt' for i in range(20)), sorted(os.listdir(dest_dir)))
+
+    def test_collect_sources(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            for name in ['a.txt', 'b.csv', 'a.txt.lock']:
+                write_to_file(os.path.join(tempdir, name), b'')
+            os.makedirs(os.path.join(tempdir, 'sub'))
+            manifest = os.path.join(tempdir, 'manifest')
+            write_to_file(manifest, b'/x/one\n\n/x/two\n')
+
+            self.assertEqual([os.path.join(tempdir, 'a.txt')], collect_sources(pattern=os.path.join(tempdir, '*.txt')))
+            self.assertEqual([os.path.join(tempdir, name) for name in ['a.txt', 'b.csv', 'manifest']],
+                             collect_sources(directory=tempdir))
+            self.assertEqual(['/x/one', '/x/two'], collect_sources(manifest=manifest))
+
+    def test_move_files_async(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            sources = [os.path.join(tempdir, f'source{i}.txt') for i in range(50)]
+            for source in sources:
+                write_to_file(source, b'Random text')
+            dest_dir = os.path.join(tempdir, 'dest')
+            lock_manager = LockManager(os.path.join(tempdir, 'movers.lock'), stripes=4)
+
+            results = asyncio.run(move_files_async(sources, dest_dir, concurrency=8, lock_manager=lock_manager))
+
+            self.assertTrue(all(result.error is None for result in results))
+            self.assertEqual(50, len(os.listdir(dest_dir)))
+            self.assertEqual(50, lock_manager.stats()['acquisitions'])
+
     def test_check_file_exists_true(self):
         with tempfile.NamedTemporaryFile() as temp_file:
             check_file_exists(temp_file.name)
@@ -86,6 +135,60 @@ class TestFileOperations(unittest.TestCase):
                 self.assertFalse(os.path.exists(source.name))
                 self.assertTrue(os.path.exists(destination))
 
+    def test_atomic_move_same_device(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            source = os.path.join(tempdir, 'source.txt')
+            destination = os.path.join(tempdir, 'dest.txt')
+            write_to_file(source, b'Random text')
+
+            atomic_move(source, destination)
+
+            self.assertFalse(os.path.exists(source))
+            self.assertEqual(b'Random text', read_file(destination))
+
+    def test_atomic_move_cross_device(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            source = os.path.join(tempdir, 'source.txt')
+            destination = os.path.join(tempdir, 'dest.txt')
+            write_to_file(source, b'Random text' * 1000)
+
+            with patch('tasks.FileMover.is_same_device', return_value=False):
+                atomic_move(source, destination)
+
+            self.assertFalse(os.path.exists(source))
+            self.assertEqual(b'Random text' * 1000, read_file(destination))
+            self.assertEqual(['dest.txt'], os.listdir(tempdir))
+
+    def test_atomic_move_across_bind_mounts(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            source = os.path.join(tempdir, 'source.txt')
+            destination = os.path.join(tempdir, 'dest.txt')
+            write_to_file(source, b'Random text' * 1000)
+            rename = os.rename
+
+            def rename_across_mounts(src, dst):
+                if src == source:
+                    raise OSError(errno.EXDEV, os.strerror(errno.EXDEV))
+                rename(src, dst)
+
+            with patch('tasks.FileMover.os.rename', side_effect=rename_across_mounts):
+                atomic_move(source, destination)
+
+            self.assertFalse(os.path.exists(source))
+            self.assertEqual(b'Random text' * 1000, read_file(destination))
+            self.assertEqual(['dest.txt'], os.listdir(tempdir))
+
+    def test_copy_to_temp_file(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            source = os.path.join(tempdir, 'source.txt')
+            write_to_file(source, b'Random text')
+
+            temp_path = copy_to_temp_file(source, tempdir)
+
+            self.assertTrue(os.path.basename(temp_path).startswith('.source.txt.'))
+            self.assertEqual(b'Random text', read_file(temp_path))
+            self.assertEqual(b'Random text', read_file(source))
+
     def test_delete_files(self):
         with tempfile.NamedTemporaryFile() as temp_file:
             delete_files([temp_file.name])
@@ -98,3 +201,155 @@ class TestFileOperations(unittest.TestCase):
 
         lock.release.assert_called_once()
 
+
+
+def hold_stripe(lock_path, path, acquired, release):
+    with LockManager(lock_path, stripes=8).acquire(path):
+        acquired.set()
+        release.wait(10)
+
+
+class TestLockManager(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.lock_path = os.path.join(self.tempdir.name, 'movers.lock')
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def test_stripe_is_stable(self):
+        manager = LockManager(self.lock_path, stripes=8)
+        self.assertEqual(manager.stripe('a/b.txt'), LockManager(self.lock_path, stripes=8).stripe('a/b.txt'))
+        self.assertTrue(0 <= manager.stripe('a/b.txt') < 8)
+
+    def test_acquire_excludes_threads(self):
+        manager = LockManager(self.lock_path, stripes=1)
+        inside = []
+
+        def worker():
+            with manager.acquire('a', 'b'):
+                inside.append(1)
+                self.assertEqual(1, len(inside))
+                time.sleep(0.01)
+                inside.pop()
+
+        threads = [threading.Thread(target=worker) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(4, manager.stats()['acquisitions'])
+        self.assertEqual(['movers.lock'], os.listdir(self.tempdir.name))
+
+    def test_acquire_times_out_across_processes(self):
+        acquired = multiprocessing.Event()
+        release = multiprocessing.Event()
+        holder = multiprocessing.Process(target=hold_stripe, args=(self.lock_path, 'a', acquired, release))
+        holder.start()
+        try:
+            self.assertTrue(acquired.wait(10))
+            manager = LockManager(self.lock_path, stripes=8)
+            with self.assertRaises(Timeout):
+                with manager.acquire('a', timeout=0.05):
+                    pass
+            self.assertEqual(1, manager.stats()['timeouts'])
+        finally:
+            release.set()
+            holder.join()
+
+
+    def test_unopenable_lock_file_is_an_error(self):
+        manager = LockManager(os.path.join(self.tempdir.name, 'missing', 'movers.lock'), stripes=8)
+        started = time.perf_counter()
+        with self.assertRaises(FileNotFoundError):
+            with manager.acquire('a'):
+                pass
+        with self.assertRaises(FileNotFoundError):
+            asyncio.run(manager.acquire_async('a').__aenter__())
+        self.assertLess(time.perf_counter() - started, 1)
+        self.assertTrue(all(lock.acquire(blocking=False) for lock in manager.thread_locks))
+
+        source = os.path.join(self.tempdir.name, 'source.txt')
+        with open(source, 'w') as f:
+            f.write('data')
+        destination = os.path.join(self.tempdir.name, 'destination')
+        os.mkdir(destination)
+        self.assertIsNone(move_file(source, destination, lock_manager=manager))
+        self.assertTrue(os.path.exists(source))
+
+    def test_acquire_async_does_not_block_loop(self):
+        manager = LockManager(self.lock_path, stripes=8)
+
+        async def run_test():
+            ticks = []
+
+            async def ticker():
+                while True:
+                    ticks.append(1)
+                    await asyncio.sleep(0.005)
+
+            ticker_task = asyncio.create_task(ticker())
+            with manager.acquire('a'):
+                with self.assertRaises(Timeout):
+                    async with manager.acquire_async('a', timeout=0.1):
+                        pass
+            async with manager.acquire_async('a', 'b'):
+                pass
+            ticker_task.cancel()
+            return len(ticks)
+
+        self.assertGreater(asyncio.run(run_test()), 5)
+        self.assertEqual(1, manager.stats()['timeouts'])
+        self.assertEqual(2, manager.stats()['acquisitions'])
+
+
+class TestMoveDaemon(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.source_dir = os.path.join(self.tempdir.name, 'source')
+        self.dest_dir = os.path.join(self.tempdir.name, 'dest')
+        os.makedirs(self.source_dir)
+        write_to_file(os.path.join(self.source_dir, 'existing.txt'), b'Random text')
+        write_to_file(os.path.join(self.source_dir, '.partial'), b'')
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def start_daemon(self, use_inotify):
+        daemon = MoveDaemon([self.source_dir], self.dest_dir, debounce=0.05, workers=2,
+                            lock_manager=LockManager(os.path.join(self.tempdir.name, 'movers.lock')),
+                            use_inotify=use_inotify)
+        thread = threading.Thread(target=daemon.run)
+        thread.start()
+        self.assertTrue(daemon.ready.wait(5))
+        return daemon, thread
+
+    def wait_until_moved(self, daemon, thread):
+        deadline = time.monotonic() + 5
+        try:
+            while len(os.listdir(self.source_dir)) > 1 and time.monotonic() < deadline:
+                time.sleep(0.01)
+        finally:
+            daemon.stop()
+            thread.join()
+        self.assertEqual(['.partial'], os.listdir(self.source_dir))
+        self.assertEqual(b'Random text', read_file(os.path.join(self.dest_dir, 'existing.txt')))
+
+    def test_run_inotify_waits_for_close(self):
+        daemon, thread = self.start_daemon(use_inotify=True)
+        with open(os.path.join(self.source_dir, 'new.txt'), 'wb') as f:
+            f.write(b'Random')
+            f.flush()
+            time.sleep(0.2)
+            self.assertFalse(os.path.exists(os.path.join(self.dest_dir, 'new.txt')))
+            f.write(b' text')
+        self.wait_until_moved(daemon, thread)
+        self.assertEqual(b'Random text', read_file(os.path.join(self.dest_dir, 'new.txt')))
+
+    def test_run_polling(self):
+        daemon, thread = self.start_daemon(use_inotify=False)
+        write_to_file(os.path.join(self.source_dir, 'new.txt'), b'Random text')
+        self.wait_until_moved(daemon, thread)
+        self.assertEqual(b'Random text', read_file(os.path.join(self.dest_dir, 'new.txt')))